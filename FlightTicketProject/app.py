@@ -1,10 +1,16 @@
 ﻿# from calendar import c
+# 使用 eventlet 啟動 SocketIO 伺服器 (monkey_patch 需在其他 import 之前)
+import eventlet
+eventlet.monkey_patch()
+import eventlet.wsgi
 from flask import Flask, request, jsonify
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, ConnectionRefusedError
 from flask_cors import CORS
 import os
+import sys
+import json
+import base64
 import requests
-import psycopg2
 #import sqlite3
 import bcrypt
 import jwt
@@ -13,11 +19,24 @@ from functools import wraps
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
 from psycopg2 import IntegrityError # PostgreSQL 約束錯誤
-# 使用 eventlet 啟動 SocketIO 伺服器
-import eventlet    
-import eventlet.wsgi
 import logging
 from backend_version import BACKEND_VERSION
+from db_pool import ConnectionPool, make_psycopg_green
+from upstream import (TokenBucket, QuotaLedger, ApiBudget, CircuitBreaker, call_with_retry,
+                      UpstreamError, UpstreamUnavailable, QuotaExceeded, CircuitOpen, INTERACTIVE, BACKGROUND)
+from search_cache import SearchCache, SingleFlight
+from price_writer import PriceCheckWriter
+from migrations import run_migrations, latest_version
+from downsample import DOWNSAMPLERS
+from partitions import ensure_partitions
+from coordination import INSTANCE_ID, run_exclusive, job_run_status
+from polling import next_check_delay
+from push_dispatcher import PushDispatcher, is_expo_token
+from realtime import ConnectionRegistry, PgEmitBus, PriceUpdateCollector, user_room
+from job_queue import enqueue_route_jobs, claim_jobs, complete_jobs, fail_job, defer_jobs, queue_stats
+from sync import (encode_sync_cursor, decode_sync_cursor, begin_snapshot, cursor_expired,
+                  load_changes, load_snapshot, purge_tombstones)
+from rollups import rollup_hourly, rollup_daily, apply_retention, choose_granularity, load_price_series
 
 print(f"Backend Version: {BACKEND_VERSION}") # 目前後端版本
 
@@ -49,112 +68,281 @@ def log_request():
 
 # 初始化 SocketIO
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode="eventlet")
+socket_registry = ConnectionRegistry()
 
 # === RapidAPI 設定 ===
 RAPIDAPI_HOST = "google-flights2.p.rapidapi.com"
 RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY")
 
+# === RapidAPI 額度 ===
+RAPIDAPI_RATE_LIMIT = float(os.getenv("RAPIDAPI_RATE_LIMIT", 5))       # 每秒補充幾個 token (0 = 不限制)
+RAPIDAPI_BURST = float(os.getenv("RAPIDAPI_BURST", 5))                 # 最多累積幾個 token
+RAPIDAPI_DAILY_QUOTA = int(os.getenv("RAPIDAPI_DAILY_QUOTA", 0))       # 每日可用次數 (0 = 不限制)
+RAPIDAPI_MONTHLY_QUOTA = int(os.getenv("RAPIDAPI_MONTHLY_QUOTA", 0))   # 每月可用次數 (0 = 不限制)
+RAPIDAPI_BACKGROUND_RESERVE = float(os.getenv("RAPIDAPI_BACKGROUND_RESERVE", 0.2)) # 保留給使用者查詢的比例
+PRICE_JOB_DEFER_SECONDS = int(os.getenv("PRICE_JOB_DEFER_SECONDS", 1800))          # 額度不足時排程延後秒數
+
+# === Expo 推播 ===
+EXPO_PUSH_BASE_URL = os.getenv("EXPO_PUSH_BASE_URL", "https://exp.host")  # 測試時可指向本機 stub
+EXPO_ACCESS_TOKEN = os.getenv("EXPO_ACCESS_TOKEN")                        # 有開啟 push security 時才需要
+PUSH_BATCH_SIZE = int(os.getenv("PUSH_BATCH_SIZE", 100))                  # 每次請求幾則 (Expo 上限 100)
+PUSH_TIMEOUT = float(os.getenv("PUSH_TIMEOUT", 10))
+PUSH_MAX_ATTEMPTS = int(os.getenv("PUSH_MAX_ATTEMPTS", 5))
+PUSH_DISPATCH_INTERVAL = float(os.getenv("PUSH_DISPATCH_INTERVAL", 2))    # 沒有待發送推播時幾秒查一次
+PUSH_RECEIPT_DELAY = int(os.getenv("PUSH_RECEIPT_DELAY", 900))            # 送出後幾秒查詢 receipt
+# 每個 web instance / worker 都會啟動 dispatcher (以 SKIP LOCKED 分工)，設為 0 可關閉
+PUSH_DISPATCHER_ENABLED = os.getenv("PUSH_DISPATCHER_ENABLED", "1") == "1"
+
+# === SocketIO 跨 process 事件匯流排 (PostgreSQL LISTEN/NOTIFY) ===
+SOCKET_EVENT_CHANNEL = os.getenv("SOCKET_EVENT_CHANNEL", "socketio_events")
+
+# === RapidAPI 逾時 / 重試 / circuit breaker ===
+RAPIDAPI_CONNECT_TIMEOUT = float(os.getenv("RAPIDAPI_CONNECT_TIMEOUT", 5))
+RAPIDAPI_READ_TIMEOUT = float(os.getenv("RAPIDAPI_READ_TIMEOUT", 20))
+RAPIDAPI_RETRIES = int(os.getenv("RAPIDAPI_RETRIES", 2))                     # 排程查詢最多重試幾次 (使用者查詢最多 1 次)
+RAPIDAPI_RETRY_BASE = float(os.getenv("RAPIDAPI_RETRY_BASE", 0.5))           # 重試等待基準秒數 (指數增加 + 抖動)
+RAPIDAPI_RETRY_MAX = float(os.getenv("RAPIDAPI_RETRY_MAX", 8))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", 0.5))         # 最近呼叫的失敗率達到多少就開啟
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", 5))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", 30))          # 開啟多久後放行試探請求
+rapidapi_breaker = CircuitBreaker(
+    "rapidapi",
+    min_calls=BREAKER_MIN_CALLS,
+    failure_threshold=BREAKER_FAILURE_RATE,
+    open_seconds=BREAKER_OPEN_SECONDS
+)
+
+# === 排程並行抓取設定 ===
+PRICE_CHECK_CONCURRENCY = int(os.getenv("PRICE_CHECK_CONCURRENCY", 8)) # 同時進行的 API 查詢數
+PRICE_WRITE_BATCH_SIZE = int(os.getenv("PRICE_WRITE_BATCH_SIZE", 500)) # 排程寫入時每個 INSERT / UPDATE 最多幾列
+
+# === 航班查詢快取設定 ===
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 512))          # 最多快取幾組查詢
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 300))          # 新鮮秒數
+SEARCH_CACHE_STALE = float(os.getenv("SEARCH_CACHE_STALE", 900))      # 過期後仍可先回傳舊資料的秒數
+PRICE_CHECK_CACHE_MAX_AGE = float(os.getenv("PRICE_CHECK_CACHE_MAX_AGE", 300)) # 排程可接受的快取年齡
+
+# 排程多久檢查一次有哪些航班到了 next_check_at (每個航班實際的檢查間隔見 polling.py)
+PRICE_CHECK_INTERVAL_MINUTES = int(os.getenv("PRICE_CHECK_INTERVAL_MINUTES", 15))
+POLL_MIN_MINUTES = int(os.getenv("POLL_MIN_MINUTES", 30))     # 單一航班最短檢查間隔
+POLL_MAX_MINUTES = int(os.getenv("POLL_MAX_MINUTES", 1440))   # 單一航班最長檢查間隔
+
+# === 票價檢查佇列設定 ===
+PRICE_JOB_BATCH_SIZE = int(os.getenv("PRICE_JOB_BATCH_SIZE", 50))          # worker 每次領取幾條航線
+PRICE_JOB_MAX_FLIGHTS = int(os.getenv("PRICE_JOB_MAX_FLIGHTS", 2000))      # 每次領取的航線合計最多幾個航班 (限制記憶體用量)
+PRICE_JOB_MAX_ATTEMPTS = int(os.getenv("PRICE_JOB_MAX_ATTEMPTS", 5))       # 超過次數移至 dead
+PRICE_JOB_RETRY_BASE = float(os.getenv("PRICE_JOB_RETRY_BASE", 60))        # 第一次重試前等待秒數 (之後倍增)
+PRICE_JOB_RETRY_MAX = float(os.getenv("PRICE_JOB_RETRY_MAX", 3600))        # 重試等待上限
+PRICE_JOB_LOCK_TIMEOUT = int(os.getenv("PRICE_JOB_LOCK_TIMEOUT", 600))     # running 超過幾秒視為 worker 已當掉
+PRICE_JOB_DEAD_DELAY = int(os.getenv("PRICE_JOB_DEAD_DELAY", 86400))       # 航線進入 dead 後幾秒才再排入
+PRICE_WORKER_IDLE_SECONDS = float(os.getenv("PRICE_WORKER_IDLE_SECONDS", 10))
+PRICE_UPDATE_MAX_DELAY = float(os.getenv("PRICE_UPDATE_MAX_DELAY", 30))    # 佇列消化不完時，price_update 最多累積幾秒就先發佈
+# web instance 是否也消化佇列 (另外部署 worker 時可設為 0)
+PRICE_WORKER_EMBEDDED = os.getenv("PRICE_WORKER_EMBEDDED", "1") == "1"
+
+# 票價歷史保留天數 (0 = 永久保留)，超過的原始資料只保留每小時 / 每日彙總
+# 注意：/prices/<id> 的完整清單與分頁只讀原始資料，開啟後這兩種查詢看不到保留期限之前的票價 (折線圖不受影響)
+PRICE_RAW_RETENTION_DAYS = int(os.getenv("PRICE_RAW_RETENTION_DAYS", 0))
+PRICE_HOURLY_RETENTION_DAYS = int(os.getenv("PRICE_HOURLY_RETENTION_DAYS", 365))
+# /sync：單次增量同步每類最多幾筆 (超過改回完整同步)；刪除紀錄保留天數 (游標更舊時改回完整同步)
+SYNC_MAX_ROWS = int(os.getenv("SYNC_MAX_ROWS", 2000))
+SYNC_TOMBSTONE_DAYS = int(os.getenv("SYNC_TOMBSTONE_DAYS", 30))
+# prices 依月份分區，預先建立未來幾個月的分區
+PRICE_PARTITION_MONTHS_AHEAD = int(os.getenv("PRICE_PARTITION_MONTHS_AHEAD", 3))
+search_cache = SearchCache(
+    maxsize=SEARCH_CACHE_SIZE,
+    ttl=SEARCH_CACHE_TTL,
+    stale_ttl=SEARCH_CACHE_STALE,
+    spawn=eventlet.spawn_n
+)
+# 相同航線同時的多個查詢只打一次 RapidAPI，其餘等待共用結果
+search_flight = SingleFlight()
+
 # 在 Render 的 Environment 設定中增加 DATABASE_URL
 DB_URL = os.environ.get("DATABASE_URL")
 
+# === PostgreSQL 連線池 ===
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))           # 等待可用連線的秒數
+DB_POOL_HEALTH_CHECK = float(os.getenv("DB_POOL_HEALTH_CHECK", 30)) # 閒置超過幾秒要先 SELECT 1
+
+make_psycopg_green() # 查詢等待時讓出 eventlet hub，不阻塞其他請求
+db_pool = ConnectionPool(
+    DB_URL,
+    minconn=DB_POOL_MIN,
+    maxconn=DB_POOL_MAX,
+    timeout=DB_POOL_TIMEOUT,
+    health_check_after=DB_POOL_HEALTH_CHECK
+)
+
 def get_db_connection():
-    # PostgreSQL 連線方式
-    conn = psycopg2.connect(DB_URL)
-    return conn
+    # 從連線池借出連線，用法: with get_db_connection() as conn:
+    return db_pool.connection()
+
+# 推播發送佇列
+push_dispatcher = PushDispatcher(
+    db_pool,
+    base_url=EXPO_PUSH_BASE_URL,
+    batch_size=PUSH_BATCH_SIZE,
+    timeout=PUSH_TIMEOUT,
+    max_attempts=PUSH_MAX_ATTEMPTS,
+    access_token=EXPO_ACCESS_TOKEN,
+    worker=INSTANCE_ID
+)
+
+# SocketIO 事件經 NOTIFY 發佈，每個 web instance 各自 LISTEN 後推給自己的連線
+# (worker 只發佈不接收；同一個 process 發佈的事件也走同一條路徑)
+socket_bus = PgEmitBus(db_pool, DB_URL, channel=SOCKET_EVENT_CHANNEL)
+
+# 所有 RapidAPI 請求共用的額度管理 (用量記在 api_usage，多個 instance / worker 共用)
+rapidapi_budget = ApiBudget(
+    TokenBucket(RAPIDAPI_RATE_LIMIT, RAPIDAPI_BURST),
+    QuotaLedger(db_pool, RAPIDAPI_HOST),
+    daily_quota=RAPIDAPI_DAILY_QUOTA,
+    monthly_quota=RAPIDAPI_MONTHLY_QUOTA,
+    background_reserve=RAPIDAPI_BACKGROUND_RESERVE
+)
+
+# === 時間欄位輸出格式 ===
+# TIMESTAMPTZ -> ISO 8601 字串 (前端用 fromisoformat 解析)
+def to_iso(dt):
+    return dt.isoformat() if dt is not None else None
+
+# 航班起降時間 (機場當地時間, TIMESTAMP) -> "YYYY-MM-DD HH:MM"，與 RapidAPI 回傳格式一致
+def to_flight_time(dt):
+    return dt.strftime("%Y-%m-%d %H:%M") if dt is not None else None
+
+# 解析查詢參數中的 ISO 8601 時間 (沒有時區時視為 UTC)，格式錯誤時丟出 ValueError
+def parse_time_arg(value):
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"時間格式錯誤: {value}")
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+# === Keyset 分頁 (以 (時間, id) 當游標，不用 OFFSET) ===
+PAGE_DEFAULT_LIMIT = 50
+PAGE_MAX_LIMIT = 500
+
+def encode_cursor(ts, row_id):
+    raw = json.dumps([ts.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    ts, row_id = json.loads(base64.urlsafe_b64decode(padded))
+    return datetime.fromisoformat(ts), int(row_id)
+
+# 回傳 (limit, before, after)；沒有任何分頁參數時回傳 None (沿用舊版完整清單)
+# 參數錯誤時丟出 ValueError
+def parse_page_args(args):
+    if not any(k in args for k in ("limit", "before", "after")):
+        return None
+
+    try:
+        limit = int(args.get("limit", PAGE_DEFAULT_LIMIT))
+        before = decode_cursor(args["before"]) if args.get("before") else None
+        after = decode_cursor(args["after"]) if args.get("after") else None
+    except Exception:
+        raise ValueError("limit 或 cursor 格式錯誤")
+    if before and after:
+        raise ValueError("before 與 after 只能擇一")
+    return min(max(limit, 1), PAGE_MAX_LIMIT), before, after
+
+# sql 為不含 ORDER BY / LIMIT 的查詢 (WHERE 之後可接 AND 條件)
+# newest_first: 預設排序是否為新到舊；往反方向翻頁時先反向查詢再倒回來
+# 時間為 NULL 的列 (m004 無法解析的舊資料) 無法當游標，分頁時略過
+# 回傳 (rows, has_more, going_back)，rows 一律依預設排序
+def fetch_keyset_page(c, sql, params, time_col, id_col, newest_first, page):
+    limit, before, after = page
+    params = list(params)
+    sql += f" AND {time_col} IS NOT NULL"
+
+    if before:
+        sql += f" AND ({time_col}, {id_col}) < (%s, %s)"
+        params += list(before)
+    if after:
+        sql += f" AND ({time_col}, {id_col}) > (%s, %s)"
+        params += list(after)
+
+    going_back = (after is not None) if newest_first else (before is not None)
+    direction = "DESC" if newest_first != going_back else "ASC"
+    c.execute(
+        sql + f" ORDER BY {time_col} {direction}, {id_col} {direction} LIMIT %s",
+        params + [limit + 1]
+    )
+    rows = c.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if going_back:
+        rows.reverse()
+    return rows, has_more, going_back
+
+# 分頁回應
+# next_cursor: 依預設排序的下一頁 (沒有更多時為 null)
+# prev_cursor: 反方向 (例如輪詢更新的資料)，沒有資料時沿用傳入的 cursor
+def page_response(items, rows, has_more, going_back, page, key):
+    limit = page[0]
+    given = request.args.get("before") or request.args.get("after")
+    return jsonify({
+        "items": items,
+        "limit": limit,
+        "has_more": has_more,
+        "next_cursor": encode_cursor(*key(rows[-1])) if rows and (has_more or going_back) else None,
+        "prev_cursor": encode_cursor(*key(rows[0])) if rows else given
+    })
 
 # === 統一初始化所有 PostgreSQL 表格 ===
+# 表格定義與索引都在 migrations.py，這裡只套用尚未執行過的版本
 def init_all_tables():
-    conn = get_db_connection()
-    c = conn.cursor()
-    try:
-        # 1. Users
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TEXT,
-                expo_push_token TEXT
-            )
-        """)
-        
-        # 2. Tracked Flights
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS tracked_flights (
-                id SERIAL PRIMARY KEY,
-                from_airport TEXT,
-                to_airport TEXT,
-                flight_number TEXT,
-                airline TEXT,
-                depart_time TEXT,
-                arrival_time TEXT,
-                price DOUBLE PRECISION,
-                user_id INTEGER REFERENCES users(id)
-            )
-        """)
-        
-        # 3. Notifications
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS notifications (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                flight_id INTEGER REFERENCES tracked_flights(id) ON DELETE SET NULL,
-                notify_time TEXT,
-                price DOUBLE PRECISION,
-                message TEXT
-            )
-        """)
-        
-        # 4. Scheduler Logs
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS scheduler_logs (
-                id SERIAL PRIMARY KEY,
-                time TEXT,
-                status TEXT
-            )
-        """)
-        
-        # 5. Prices
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS prices (
-                id SERIAL PRIMARY KEY,
-                flight_id INTEGER REFERENCES tracked_flights(id) ON DELETE CASCADE,
-                checked_time TEXT,
-                price DOUBLE PRECISION
-            )
-        """)
-        
-        conn.commit()
-        print("✅ PostgreSQL 資料表初始化完成")
-    except Exception as e:
-        print(f"❌ 初始化資料表失敗: {e}")
-        conn.rollback()
-    finally:
-        c.close()
-        conn.close()
+    with get_db_connection() as conn:
+        try:
+            applied = run_migrations(conn)
+            if applied:
+                print(f"✅ PostgreSQL 資料表初始化完成 (套用 migration {applied}，目前版本 {latest_version()})")
+            else:
+                print(f"✅ PostgreSQL 資料表已是最新版本 ({latest_version()})")
+            # 停機期間可能跨月，啟動時先補齊本月與未來的票價分區
+            ensure_partitions(conn, PRICE_PARTITION_MONTHS_AHEAD)
+        except Exception as e:
+            # schema 只套用一半時不能繼續服務
+            print(f"❌ 初始化資料表失敗: {e}")
+            raise
 # ------------------------------------
 # === 刪除所有 PostgreSQL 表格 ===
 def drop_all_tables():
-    conn = get_db_connection()
-    c = conn.cursor()
-    try:
-        # 依序刪除（或使用 CASCADE）
-        c.execute("DROP TABLE IF EXISTS prices CASCADE")
-        c.execute("DROP TABLE IF EXISTS notifications CASCADE")
-        c.execute("DROP TABLE IF EXISTS scheduler_logs CASCADE")
-        c.execute("DROP TABLE IF EXISTS tracked_flights CASCADE")
-        c.execute("DROP TABLE IF EXISTS users CASCADE")
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        try:
+            # 依序刪除（或使用 CASCADE）
+            c.execute("DROP TABLE IF EXISTS prices CASCADE")
+            c.execute("DROP TABLE IF EXISTS prices_undated CASCADE")
+            c.execute("DROP TABLE IF EXISTS prices_hourly CASCADE")
+            c.execute("DROP TABLE IF EXISTS prices_daily CASCADE")
+            c.execute("DROP TABLE IF EXISTS rollup_state CASCADE")
+            c.execute("DROP TABLE IF EXISTS job_runs CASCADE")
+            c.execute("DROP TABLE IF EXISTS price_check_jobs CASCADE")
+            c.execute("DROP TABLE IF EXISTS api_usage CASCADE")
+            c.execute("DROP TABLE IF EXISTS push_outbox CASCADE")
+            c.execute("DROP TABLE IF EXISTS sync_tombstones CASCADE")
+            c.execute("DROP TABLE IF EXISTS notifications CASCADE")
+            c.execute("DROP TABLE IF EXISTS scheduler_logs CASCADE")
+            c.execute("DROP TABLE IF EXISTS tracked_flights CASCADE")
+            c.execute("DROP TABLE IF EXISTS users CASCADE")
+            c.execute("DROP TABLE IF EXISTS schema_migrations CASCADE")
 
-        conn.commit()
-        print("🗑️ 所有 PostgreSQL 資料表已刪除")
+            conn.commit()
+            print("🗑️ 所有 PostgreSQL 資料表已刪除")
 
-    except Exception as e:
-        print(f"❌ 刪除資料表失敗: {e}")
-        conn.rollback()
+        except Exception as e:
+            print(f"❌ 刪除資料表失敗: {e}")
+            conn.rollback()
 
-    finally:
-        c.close()
-        conn.close()
+        finally:
+            c.close()
 # ------------------------------------
 
 
@@ -221,20 +409,18 @@ def register():
 
     password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    try:
-        c.execute("""
-            INSERT INTO users (username, password_hash, created_at)
-            VALUES (%s, %s, %s)
-        """, (username, password_hash, datetime.now(timezone.utc).isoformat()))
-        conn.commit()
-    except IntegrityError:
-        return jsonify({"error": "此使用者已存在"}), 400
-    finally:
-        c.close()
-        conn.close()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("""
+                INSERT INTO users (username, password_hash, created_at)
+                VALUES (%s, %s, %s)
+            """, (username, password_hash, datetime.now(timezone.utc)))
+            conn.commit()
+        except IntegrityError:
+            return jsonify({"error": "此使用者已存在"}), 400
+        finally:
+            c.close()
     
     return jsonify({"message": "註冊成功"}), 200
 
@@ -249,29 +435,27 @@ def login():
     password = data.get("password")
     push_token = data.get("push_token") # 接收前端傳來的 Token
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, password_hash FROM users WHERE username = %s", (username,))
-    row = c.fetchone()
-    c.close()
-    conn.close()
-    
-    if not row:
-        return jsonify({"error": "使用者不存在"}), 400
-    
-    user_id, password_hash = row
-    
-    if not bcrypt.checkpw(password.encode(), password_hash.encode()):
-        return jsonify({"error": "密碼錯誤"}), 400
-
-    # 登入成功後，更新 Push Token
-    if push_token:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET expo_push_token = %s WHERE id = %s", (push_token, user_id))
-        conn.commit()
-        cur.close()
-        conn.close()
+    # 查詢與更新 Push Token 共用同一條連線
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, password_hash FROM users WHERE username = %s", (username,))
+        row = c.fetchone()
+        
+        if not row:
+            c.close()
+            return jsonify({"error": "使用者不存在"}), 400
+        
+        user_id, password_hash = row
+        
+        if not bcrypt.checkpw(password.encode(), password_hash.encode()):
+            c.close()
+            return jsonify({"error": "密碼錯誤"}), 400
+
+        # 登入成功後，更新 Push Token
+        if push_token:
+            c.execute("UPDATE users SET expo_push_token = %s WHERE id = %s", (push_token, user_id))
+            conn.commit()
+        c.close()
     
     token = jwt.encode(
         {
@@ -301,29 +485,26 @@ def change_password():
     if not old_pw or not new_pw:
         return jsonify({"error": "缺少 old/new password"}), 400
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT password_hash FROM users WHERE id = %s", (request.user_id,))
-    row = c.fetchone()
-    
-    if not row:
-        c.close()
-        conn.close()
-        return jsonify({"error": "找不到使用者"}), 404
-    hashed = row[0]
-
-    # 驗證舊密碼
-    if not bcrypt.checkpw(old_pw.encode(), hashed.encode()):
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT password_hash FROM users WHERE id = %s", (request.user_id,))
+        row = c.fetchone()
+        
+        if not row:
+            c.close()
+            return jsonify({"error": "找不到使用者"}), 404
+        hashed = row[0]
+
+        # 驗證舊密碼
+        if not bcrypt.checkpw(old_pw.encode(), hashed.encode()):
+            c.close()
+            return jsonify({"error": "舊密碼錯誤"}), 400
+
+        # 新密碼加密
+        new_hashed = bcrypt.hashpw(new_pw.encode(), bcrypt.gensalt()).decode()
+        c.execute("UPDATE users SET password_hash = %s WHERE id = %s", (new_hashed, request.user_id))
+        conn.commit()
         c.close()
-        conn.close()
-        return jsonify({"error": "舊密碼錯誤"}), 400
-
-    # 新密碼加密
-    new_hashed = bcrypt.hashpw(new_pw.encode(), bcrypt.gensalt()).decode()
-    c.execute("UPDATE users SET password_hash = %s WHERE id = %s", (new_hashed, request.user_id))
-    conn.commit()
-    c.close()
-    conn.close()
     
     return jsonify({"message": "密碼更新成功"})
 
@@ -331,81 +512,89 @@ def change_password():
 @app.route("/profile", methods=["GET"])
 @token_required
 def get_profile():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, username, created_at FROM users WHERE id = %s", (request.user_id,))
-    row = c.fetchone()
-    c.close()
-    conn.close()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, username, created_at FROM users WHERE id = %s", (request.user_id,))
+        row = c.fetchone()
+        c.close()
     
     if not row:
         return jsonify({"error": "找不到使用者"}), 404
     return jsonify({
         "user_id": row[0],
         "username": row[1],
-        "created_at": row[2]
+        "created_at": to_iso(row[2])
     })
 
 
 # === 查詢排程結果記錄 (所有使用者的) ===
 @app.route("/check_logs", methods=["GET"])
 def get_scheduler_logs():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT time, status FROM scheduler_logs ORDER BY time DESC LIMIT 20")
-    rows = c.fetchall()
-    c.close()
-    conn.close()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT time, status FROM scheduler_logs ORDER BY time DESC LIMIT 20")
+        rows = c.fetchall()
+        c.close()
     
-    return jsonify([{"time": r[0], "status": r[1]} for r in rows])
+    return jsonify([{"time": to_iso(r[0]), "status": r[1]} for r in rows])
+
+# (id, flight_id, message, notify_time, price) -> JSON
+def notification_json(r):
+    return {
+        "id": r[0],
+        "flight_id": r[1],
+        "time": to_iso(r[3]),
+        "price": r[4],
+        "message": r[2]
+    }
 
 # === 查詢通知紀錄 ===
+# 分頁: ?limit=50 → 最新的 50 筆；?before=<next_cursor> 更舊；?after=<prev_cursor> 更新
+# 沒帶分頁參數時回傳完整清單 (舊版前端相容)
 @app.route("/notifications", methods=["GET"])
 @login_required
 def get_notifications():
     user_id = request.user_id
+    try:
+        page = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, flight_id, message, notify_time, price
-        FROM notifications
-        WHERE user_id = %s
-        ORDER BY notify_time DESC
-    """, (user_id,))
-
-    rows = c.fetchall()
-    c.close()
-    conn.close()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        sql = """
+            SELECT id, flight_id, message, notify_time, price
+            FROM notifications
+            WHERE user_id = %s
+        """
+        if page:
+            rows, has_more, going_back = fetch_keyset_page(
+                c, sql, (user_id,), "notify_time", "id", True, page
+            )
+        else:
+            c.execute(sql + " ORDER BY notify_time DESC, id DESC", (user_id,))
+            rows = c.fetchall()
+        c.close()
     
-    data = []
-    for r in rows:
-        data.append({
-            "id": r[0],
-            "flight_id": r[1],
-            "time": r[3],
-            "price": r[4],
-            "message": r[2]
-        })
+    data = [notification_json(r) for r in rows]
 
+    if page:
+        return page_response(data, rows, has_more, going_back, page, key=lambda r: (r[3], r[0]))
     return jsonify(data)
 
-# === 查詢航班 ===
-@app.route("/price", methods=["GET"])
-def get_price():
-    departure_id = request.args.get("from")
-    arrival_id = request.args.get("to")
-    outbound_date = request.args.get("depart")
-    return_date = request.args.get("return")
-
+# === RapidAPI 航班查詢 (查詢航班 / 排程共用) ===
+# 呼叫 searchFlights，回傳該航線所有可訂的航班 (依 API 回傳順序)
+# lane: interactive (使用者查詢) / background (排程)
+# 額度不足丟出 QuotaExceeded、circuit 開啟丟出 CircuitOpen (都是 UpstreamUnavailable)
+def search_route_flights(from_airport, to_airport, outbound_date, lane=BACKGROUND):
     url = f"https://{RAPIDAPI_HOST}/api/v1/searchFlights"
     headers = {
         "x-rapidapi-key": RAPIDAPI_KEY,
         "x-rapidapi-host": RAPIDAPI_HOST
     }
-    querystring = {
-        "departure_id": departure_id,
-        "arrival_id": arrival_id,
+    query = {
+        "departure_id": from_airport,
+        "arrival_id": to_airport,
         "outbound_date": outbound_date,
         # "return_date": return_date, 不看回程 所有都預設單趟
         "adults": "1",
@@ -413,58 +602,97 @@ def get_price():
         "trip_type": "one_way" # 強制告訴 API 我只要看單程
     }
 
-    response = requests.get(url, headers=headers, params=querystring)
-    if response.status_code != 200:
+    def send():
+        rapidapi_budget.acquire(lane)
+        res = requests.get(url, headers=headers, params=query,
+                           timeout=(RAPIDAPI_CONNECT_TIMEOUT, RAPIDAPI_READ_TIMEOUT))
+        if res.status_code != 200:
+            retry_after = res.headers.get("Retry-After")
+            raise UpstreamError(res.status_code, res.text,
+                                float(retry_after) if retry_after and retry_after.isdigit() else None)
+        return res.json()
+
+    # 使用者在等回應，最多只重試一次
+    retries = RAPIDAPI_RETRIES if lane == BACKGROUND else min(RAPIDAPI_RETRIES, 1)
+    data = call_with_retry(send, rapidapi_breaker, retries, RAPIDAPI_RETRY_BASE, RAPIDAPI_RETRY_MAX)
+    itineraries = data.get("data", {}).get("itineraries", {})
+    # 把所有可能的航班清單合併
+    all_itineraries = itineraries.get("topFlights", []) + itineraries.get("otherFlights", [])
+
+    flights = []
+    for f in all_itineraries:
+        if f["price"] == "unavailable": # 取全部來看 跳過unavailable
+            continue
+        flights.append({
+            "from": from_airport,
+            "to": to_airport,
+            "airline": f["flights"][0]["airline"],
+            "flight_number": f["flights"][0]["flight_number"],
+            "depart_time": f["flights"][0]["departure_airport"]["time"],
+            "arrival_time": f["flights"][0]["arrival_airport"]["time"],
+            "price": float(f["price"])
+        })
+    return flights
+
+# 先查快取再呼叫 API；max_age 用來要求比較新的資料 (例如排程)
+# 快取沒命中時經由 search_flight 合併同時進行的相同查詢
+# 查到的航班不分 lane 共用快取；合併則只限同一個 lane，使用者查詢不會等排程的重試 / 背景配額用完的錯誤
+def cached_route_search(from_airport, to_airport, outbound_date, max_age=None, lane=INTERACTIVE):
+    key = route_key(from_airport, to_airport, outbound_date)
+    return search_cache.get_or_load(
+        key,
+        lambda: search_flight.do(key + (lane,), lambda: search_route_flights(*key, lane=lane)),
+        max_age=max_age
+    )
+
+# === 查詢航班 ===
+@app.route("/price", methods=["GET"])
+def get_price():
+    departure_id = request.args.get("from")
+    arrival_id = request.args.get("to")
+    outbound_date = request.args.get("depart")
+    return_date = request.args.get("return")
+
+    if not departure_id or not arrival_id or not outbound_date:
+        return jsonify({"error": "請輸入 from、to 與 depart"}), 400
+
+    try:
+        flights = cached_route_search(departure_id, arrival_id, outbound_date)
+    except QuotaExceeded as e:
+        return jsonify({"error": "查詢額度已用完，請稍後再試", "details": str(e)}), 429
+    except CircuitOpen as e:
+        return jsonify({"error": "航班資料來源暫時無法使用，請稍後再試", "details": str(e)}), 503
+    except UpstreamError as e:
         return jsonify({
             "error": "API 呼叫失敗",
-            "status_code": response.status_code,
-            "response": response.text
+            "status_code": e.status_code,
+            "response": e.text
         }), 400
+    except Exception as e:
+        return jsonify({
+            "error": "無法解析航班資料",
+            "details": str(e)
+        }), 500
 
-    data = response.json()
-    try:
-        itineraries = data.get("data", {}).get("itineraries", {})
-        all_itineraries = itineraries.get("topFlights", []) + itineraries.get("otherFlights", [])
-
-        if not all_itineraries:
-            return jsonify({
-                "from": departure_id,
-                "to": arrival_id,
-                "outbound_date": outbound_date,
-                "message": "查無符合的航班資料"
-            })
-        
-        flights = []
-        for f in all_itineraries:
-            if f["price"] == "unavailable": # 取全部來看 跳過unavailable
-                continue
-            flights.append({
-                "from": departure_id,
-                "to": arrival_id,
-                "airline": f["flights"][0]["airline"],
-                "flight_number": f["flights"][0]["flight_number"],
-                "depart_time": f["flights"][0]["departure_airport"]["time"],
-                "arrival_time": f["flights"][0]["arrival_airport"]["time"],
-                "price": float(f["price"])
-            })
-        
-            flights.sort(key=lambda x: x["price"])
-        cheapest_flights = flights[:10]
-        
+    if not flights:
         return jsonify({
             "from": departure_id,
             "to": arrival_id,
             "outbound_date": outbound_date,
-            "return_date": return_date,
-            "flights": cheapest_flights
+            "message": "查無符合的航班資料"
         })
-    
-    except Exception as e:
-        return jsonify({
-            "error": "無法解析航班資料",
-            "details": str(e),
-            "raw": data
-        }), 500
+
+    cheapest_flights = sorted(flights, key=lambda x: x["price"])[:10]
+    # 快取裡的航線代碼是正規化後的，回傳時沿用使用者輸入
+    cheapest_flights = [dict(f, **{"from": departure_id, "to": arrival_id}) for f in cheapest_flights]
+
+    return jsonify({
+        "from": departure_id,
+        "to": arrival_id,
+        "outbound_date": outbound_date,
+        "return_date": return_date,
+        "flights": cheapest_flights
+    })
 
 # === 加入追蹤 ===
 @app.route("/flights", methods=["POST"])
@@ -480,100 +708,158 @@ def add_flight():
         if field not in data:
             return jsonify({"error": f"缺少必要欄位：{field}"}), 400
 
-    conn = get_db_connection()
-    c = conn.cursor()
+    with get_db_connection() as conn:
+        c = conn.cursor()
 
-    # 檢查是否已經追蹤過（同user、同航班號、同出發時間）
-    c.execute("""
-        SELECT id FROM tracked_flights 
-        WHERE user_id = %s AND flight_number = %s AND depart_time = %s
-    """, (user_id, data["flight_number"], data["depart_time"]))
-
-    existing_flight = c.fetchone()
-    if existing_flight:
+        # 加入追蹤 (加入時的票價即為第一筆檢查紀錄)
+        # 已經追蹤過（同user、同航班號、同出發時間）由 unique constraint 擋下，不會有競爭條件
+        now = datetime.now(timezone.utc)
+        c.execute("""
+            INSERT INTO tracked_flights (from_airport, to_airport, flight_number, airline, depart_time, arrival_time, price, user_id,
+                                         min_price, last_checked_at, check_count)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 1)
+            ON CONFLICT (user_id, flight_number, depart_time) DO NOTHING
+            RETURNING id
+        """, (
+            data["from"], data["to"], data["flight_number"], data["airline"],
+            data["depart_time"], data["arrival_time"], data["price"], user_id,
+            data["price"], now
+        ))
+        row = c.fetchone()
+        if not row:
+            c.close()
+            return jsonify({"error": f"您已經追蹤過此航班 {data['flight_number']} 了"}), 409
+        flight_id = row[0]
+
+        # 寫入 price history
+        c.execute("""
+            INSERT INTO prices (flight_id, checked_time, price)
+            VALUES (%s, %s, %s)
+        """, (flight_id, now, data["price"]))
+        
+        conn.commit()
         c.close()
-        conn.close()
-        return jsonify({"error": f"您已經追蹤過此航班 {data['flight_number']} 了"}), 409
-
-    # 沒追蹤過 加入追蹤
-    c.execute("""
-        INSERT INTO tracked_flights (from_airport, to_airport, flight_number, airline, depart_time, arrival_time, price, user_id)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-    """, (
-        data["from"], data["to"], data["flight_number"], data["airline"],
-        data["depart_time"], data["arrival_time"], data["price"], user_id
-    ))
-    flight_id = c.fetchone()[0]
-
-    # 寫入 price history
-    now = datetime.now(timezone.utc).isoformat()
-    c.execute("""
-        INSERT INTO prices (flight_id, checked_time, price)
-        VALUES (%s, %s, %s)
-    """, (flight_id, now, data["price"]))
-    
-    conn.commit()
-    c.close()
-    conn.close()
     
     return jsonify({"message": f"已成功加入追蹤航班 {data['flight_number']}"}), 200
 
+# tracked_flights 查詢結果 -> JSON
+def flight_json(row):
+    return {
+        "id": row[0],
+        "from": row[1],
+        "to": row[2],
+        "flight_number": row[3],
+        "airline": row[4],
+        "depart_time": to_flight_time(row[5]),
+        "arrival_time": to_flight_time(row[6]),
+        "price": row[7],
+        "min_price": row[8],
+        "last_checked_at": to_iso(row[9]),
+        "check_count": row[10],
+        "next_check_at": to_iso(row[11]),
+        "updated_at": to_iso(row[12])
+    }
+
 # === 查詢目前追蹤中的航班 ===
 @app.route("/flights", methods=["GET"])
 @login_required
 def get_tracked_flights():
     user_id = request.user_id
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, from_airport, to_airport, flight_number, airline, depart_time, arrival_time, price
-        FROM tracked_flights
-        WHERE user_id = %s
-    """, (user_id,))
-    rows = c.fetchall()
-    c.close()
-    conn.close()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT id, from_airport, to_airport, flight_number, airline, depart_time, arrival_time, price,
+                   min_price, last_checked_at, check_count, next_check_at, updated_at
+            FROM tracked_flights
+            WHERE user_id = %s
+        """, (user_id,))
+        rows = c.fetchall()
+        c.close()
     
-    flights = []
-    for row in rows:
-        flights.append({
-            "id": row[0],
-            "from": row[1],
-            "to": row[2],
-            "flight_number": row[3],
-            "airline": row[4],
-            "depart_time": row[5],
-            "arrival_time": row[6],
-            "price": row[7]
-        })
-    return jsonify(flights)
+    return jsonify([flight_json(row) for row in rows])
 
 # === 查詢票價歷史 ===
+# 分頁: ?limit=500 → 最早的 500 筆；?after=<next_cursor> 更新；?before=<prev_cursor> 更舊
+# 折線圖: ?points=200 → 伺服器端降採樣到最多 200 點 (method=minmax 保留低點 / lttb)
+# 時間範圍: ?from=<ISO 8601>&to=<ISO 8601>，可與上面兩種搭配
+# 沒帶分頁 / points 參數時回傳完整清單 (舊版前端相容)
+CHART_MAX_POINTS = 2000
+
 @app.route("/prices/<int:flight_id>", methods=["GET"])
 @login_required
 def get_price_history(flight_id):
     user_id = request.user_id
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    # 確認這個 flight 是此使用者的
-    c.execute("SELECT 1 FROM tracked_flights WHERE id = %s AND user_id = %s", (flight_id, user_id))
-    if not c.fetchone():
+    try:
+        page = parse_page_args(request.args)
+        range_from = parse_time_arg(request.args.get("from"))
+        range_to = parse_time_arg(request.args.get("to"))
+        points = int(request.args["points"]) if request.args.get("points") else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    method = request.args.get("method", "minmax")
+    if method not in DOWNSAMPLERS:
+        return jsonify({"error": f"method 只能是 {', '.join(DOWNSAMPLERS)}"}), 400
+    if points is not None and page:
+        return jsonify({"error": "points 不能與 limit / before / after 同時使用"}), 400
+    granularity = request.args.get("granularity", "auto")
+    if granularity not in ("auto", "raw", "hourly", "daily"):
+        return jsonify({"error": "granularity 只能是 auto, raw, hourly, daily"}), 400
+
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        
+        # 確認這個 flight 是此使用者的
+        c.execute("SELECT 1 FROM tracked_flights WHERE id = %s AND user_id = %s", (flight_id, user_id))
+        if not c.fetchone():
+            c.close()
+            return jsonify({"error": "無權查詢此航班或航班不存在"}), 404
+
+        # 折線圖：依查詢範圍挑選原始資料或每小時 / 每日彙總，再降採樣
+        if points is not None:
+            points = min(max(points, 2), CHART_MAX_POINTS)
+            if granularity == "auto":
+                granularity = choose_granularity(
+                    c, flight_id, range_from, range_to, points, PRICE_RAW_RETENTION_DAYS
+                )
+            # minmax 取每段最低價，保留低點；lttb 取每段最後價格
+            value = "min" if method == "minmax" else "last"
+            rows = load_price_series(c, flight_id, range_from, range_to, granularity, value)
+            c.close()
+            series = DOWNSAMPLERS[method](rows, points)
+            return jsonify({
+                "items": [{"time": to_iso(t), "price": p} for t, p in series],
+                "total": len(rows),
+                "points": len(series),
+                "method": method,
+                "granularity": granularity
+            })
+        
+        sql = "SELECT id, checked_time, price FROM prices WHERE flight_id = %s"
+        params = [flight_id]
+        if range_from:
+            sql += " AND checked_time >= %s"
+            params.append(range_from)
+        if range_to:
+            sql += " AND checked_time < %s"
+            params.append(range_to)
+
+        if page:
+            rows, has_more, going_back = fetch_keyset_page(
+                c, sql, params, "checked_time", "id", False, page
+            )
+        else:
+            c.execute(sql + " ORDER BY checked_time ASC, id ASC", params)
+            rows = c.fetchall()
         c.close()
-        conn.close()
-        return jsonify({"error": "無權查詢此航班或航班不存在"}), 404
-    
-    c.execute("SELECT checked_time, price FROM prices WHERE flight_id = %s ORDER BY checked_time ASC", (flight_id,))
-    rows = c.fetchall()
-    c.close()
-    conn.close()
-    
+
+    data = [{"time": to_iso(r[1]), "price": r[2]} for r in rows]
+    if page:
+        return page_response(data, rows, has_more, going_back, page, key=lambda r: (r[1], r[0]))
+
     if not rows:
         return jsonify({"message": "尚無此航班的歷史票價資料"}), 404
-    
-    data = [{"time": r[0], "price": r[1]} for r in rows]
     return jsonify(data)
 
 # === 刪除追蹤中的航班 ===
@@ -581,231 +867,505 @@ def get_price_history(flight_id):
 @login_required
 def delete_flight(flight_id):
     user_id = request.user_id
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM tracked_flights WHERE id = %s AND user_id = %s", (flight_id, user_id))
-    deleted = c.rowcount
-    conn.commit()
-    c.close()
-    conn.close()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM tracked_flights WHERE id = %s AND user_id = %s", (flight_id, user_id))
+        deleted = c.rowcount
+        conn.commit()
+        c.close()
     
     if deleted == 0:
         return jsonify({"error": "找不到此航班或無權刪除"}), 404
     
     return jsonify({"message": f"已刪除追蹤航班 ID {flight_id}"}), 200
 
+# /sync 的航班只含會改變 version 的欄位 (排程記錄欄位不算修改，放進來會與完整同步不一致)
+def sync_flight_json(row):
+    return {
+        "id": row[0],
+        "from": row[1],
+        "to": row[2],
+        "flight_number": row[3],
+        "airline": row[4],
+        "depart_time": to_flight_time(row[5]),
+        "arrival_time": to_flight_time(row[6]),
+        "price": row[7],
+        "min_price": row[8],
+        "updated_at": to_iso(row[9])
+    }
+
+# === 增量同步 ===
+# ?since=<cursor> → 上次同步後新增 / 修改的航班、通知、票價，與被刪除的航班 / 通知 id
+# 沒帶 since (或游標過期、變動太多) 時 reset=true：回傳目前所有航班與通知，前端整個取代本地資料
+# (完整同步不含票價歷史，需要時再查 /prices/<id>)；回應中的 cursor 留給下一次同步
+@app.route("/sync", methods=["GET"])
+@login_required
+def sync_changes():
+    user_id = request.user_id
+    since = None
+    if request.args.get("since"):
+        try:
+            since, issued_at = decode_sync_cursor(request.args["since"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if cursor_expired(issued_at, SYNC_TOMBSTONE_DAYS):
+            since = None
+
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        upto, now = begin_snapshot(c)
+        changes = load_changes(c, user_id, since, upto, SYNC_MAX_ROWS) if since is not None else None
+        if changes is None:
+            flights, notifications = load_snapshot(c, user_id)
+            prices, deleted = [], {"flights": [], "notifications": []}
+        else:
+            flights, notifications, prices, deleted = changes
+        conn.commit()
+        c.close()
+
+    return jsonify({
+        "cursor": encode_sync_cursor(upto, now),
+        "reset": changes is None,
+        "flights": [sync_flight_json(r) for r in flights],
+        "notifications": [notification_json(r) for r in notifications],
+        "prices": [{"id": r[0], "flight_id": r[1], "time": to_iso(r[2]), "price": r[3]} for r in prices],
+        "deleted": deleted
+    })
+
 # 檢查expo_push_token
 @app.route("/debug/tokens")
 def debug_tokens():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT username, expo_push_token FROM users")
-    users = c.fetchall()
-    c.close()
-    conn.close()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT username, expo_push_token FROM users")
+        users = c.fetchall()
+        c.close()
     return jsonify(users)
 
+# 檢查連線池狀態
+@app.route("/debug/pool")
+def debug_pool():
+    return jsonify(db_pool.stats())
+
+# 檢查航班查詢快取狀態
+@app.route("/debug/cache")
+def debug_cache():
+    return jsonify(dict(search_cache.stats(), singleflight=search_flight.stats()))
+
+# 檢查各排程工作最後一次執行的狀態
+@app.route("/debug/scheduler")
+def debug_scheduler():
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        rows = job_run_status(c)
+        c.close()
+    return jsonify([{
+        "job": r[0],
+        "slot": r[1],
+        "owner": r[2],
+        "started_at": to_iso(r[3]),
+        "finished_at": to_iso(r[4]),
+        "status": r[5]
+    } for r in rows])
+
+# 檢查 RapidAPI 額度與限速狀態
+@app.route("/debug/quota")
+def debug_quota():
+    return jsonify(rapidapi_budget.stats())
+
+# 檢查推播發送佇列
+@app.route("/debug/push")
+def debug_push():
+    return jsonify(push_dispatcher.stats())
+
+# 檢查 RapidAPI circuit breaker 狀態
+@app.route("/debug/breaker")
+def debug_breaker():
+    return jsonify(rapidapi_breaker.stats())
+
+# 檢查票價檢查佇列 (各狀態數量與最近的 dead 工作)
+@app.route("/debug/jobs")
+def debug_jobs():
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        counts, dead = queue_stats(c)
+        c.close()
+    return jsonify({
+        "counts": counts,
+        "dead": [{
+            "id": r[0],
+            "route": f"{r[1]} -> {r[2]}",
+            "depart_date": r[3].isoformat(),
+            "attempts": r[4],
+            "last_error": r[5],
+            "finished_at": to_iso(r[6])
+        } for r in dead]
+    })
+
+# 檢查 SocketIO 連線數與 room 數
+@app.route("/debug/sockets")
+def debug_sockets():
+    data = socket_registry.stats()
+    data["bus"] = socket_bus.stats()
+    return jsonify(data)
+
 # ------------------------------------
-# 發送推播
-def send_push_notification(expo_token, title, body):
-    if not expo_token or not expo_token.startswith("ExponentPushToken"):
-        return
-        
-    url = "https://exp.host/--/api/v2/push/send"
-    payload = {
-        "to": expo_token,
-        "title": title,
-        "body": body,
-        "sound": "default",
-        "data": {"type": "price_drop"} # 可以放自訂資料
-    }
-    
+# === SocketIO 連線驗證 ===
+# 與 login_required 使用同一個 JWT：client 連線時帶 auth={"token": ...}
+# (或 Authorization: Bearer ... header)，驗證後加入自己的 room
+@socketio.on("connect")
+def socket_connect(auth=None):
+    token = (auth or {}).get("token") if isinstance(auth, dict) else None
+    if not token:
+        auth_header = request.headers.get("Authorization", "")
+        if auth_header.startswith("Bearer "):
+            token = auth_header.split(" ")[1]
+    if not token:
+        socket_registry.reject()
+        raise ConnectionRefusedError("缺少 token")
+
     try:
-        response = requests.post(url, json=payload)
-        print(f"📡 推播發送結果: {response.json()}")
-    except Exception as e:
-        print(f"❌ 推播發送失敗: {e}")
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO])
+    except jwt.ExpiredSignatureError:
+        socket_registry.reject()
+        raise ConnectionRefusedError("Token 已過期")
+    except Exception:
+        socket_registry.reject()
+        raise ConnectionRefusedError("Token 無效")
+
+    user_id = payload["user_id"]
+    join_room(user_room(user_id))
+    socket_registry.add(request.sid, user_id)
+
+@socketio.on("disconnect")
+def socket_disconnect(*args):
+    socket_registry.remove(request.sid)
+
+# 從事件匯流排收到的事件 (可能來自其他 instance / worker)，推給本機連線中的 room
+def deliver_socket_event(event, data, room):
+    socketio.emit(event, data, to=room)
 
 # == 標準日期 ==
 def normalize_date(dt):
+    if isinstance(dt, date): # DATE / TIMESTAMP 欄位 (datetime 也是 date 的子類別)
+        return dt.strftime("%Y-%m-%d")
     return datetime.strptime(dt.split()[0], "%Y-%m-%d").strftime("%Y-%m-%d")
 
-# === 查詢最新票價 ===
-def fetch_latest_price(from_airport, to_airport, depart_time, return_time, flight_number):
-    # 清理航班編號與日期格式
-    flight_number = flight_number.replace(" ", "").strip()
+# == 標準航班編號 (例如 "MM 930" -> "MM930") ==
+def normalize_flight_number(flight_number):
+    return flight_number.replace(" ", "").upper().strip()
 
-    url = f"https://{RAPIDAPI_HOST}/api/v1/searchFlights"
-    headers = {
-        "x-rapidapi-key": RAPIDAPI_KEY,
-        "x-rapidapi-host": RAPIDAPI_HOST
-    }
-    query = {
-        "departure_id": from_airport,
-        "arrival_id": to_airport,
-        "outbound_date": normalize_date(depart_time),
-        "adults": "1",
-        "currency": "TWD",
-        "trip_type": "one_way" # 提示 API 單程
-    }
-    # 確保 flight_number 乾淨，例如 "MM930"
-    target_f_no = flight_number.replace(" ", "").upper().strip()
+# == 航線分組鍵：同出發地、目的地、出發日期的航班共用一次查詢 ==
+def route_key(from_airport, to_airport, depart_time):
+    return (
+        from_airport.strip().upper(),
+        to_airport.strip().upper(),
+        normalize_date(depart_time)
+    )
 
-    try:
-        res = requests.get(url, headers=headers, params=query, timeout=30)
-        if res.status_code != 200:
-            print(f"⚠️ API 錯誤: {res.status_code} {res.text[:200]}")
-            return None
-        
-        data = res.json()
-        itineraries = data.get("data", {}).get("itineraries", {})
-        
-        # 把所有可能的航班清單合併
-        all_itineraries = (
-            itineraries.get("topFlights", []) + 
-            itineraries.get("otherFlights", [])
-        )
+# === 查詢整條航線的最新票價 ===
+# 回傳 {航班編號: 票價}，API 失敗時回傳 None
+# 額度不足 / circuit 開啟時丟出 UpstreamUnavailable (由呼叫端延後)
+# 快取中不超過 PRICE_CHECK_CACHE_MAX_AGE 秒的查詢結果可直接沿用
+def fetch_route_prices(from_airport, to_airport, outbound_date, max_age=None):
+    if max_age is None:
+        max_age = PRICE_CHECK_CACHE_MAX_AGE
 
-        for f in all_itineraries:
-            f_no = f["flights"][0]["flight_number"].replace(" ", "").upper().strip()
-          
-            # 比對價格與編號
-            if f["price"] != "unavailable" and f_no == target_f_no:
-                return float(f["price"])
-        
-        print(f"⚠️ 找不到航班 {flight_number} 的最新票價")
+    try:
+        flights = cached_route_search(from_airport, to_airport, outbound_date,
+                                      max_age=max_age, lane=BACKGROUND)
+    except UpstreamUnavailable:
+        raise
+    except UpstreamError as e:
+        print(f"⚠️ API 錯誤: {e.status_code} {e.text[:200]}")
         return None
-    
     except Exception as e:
         print(f"⚠️ 抓取票價錯誤: {e}")
         return None
 
-# 自動檢查票價
-def scheduled_price_check():
-    print("🔄 開始自動檢查票價...")
-    conn = get_db_connection()
+    prices = {}
+    for f in flights:
+        # 同航班號出現多次時，沿用 API 回傳順序的第一筆
+        prices.setdefault(normalize_flight_number(f["flight_number"]), f["price"])
+    return prices
+
+# === 並行查詢多條航線 ===
+# 用 GreenPool 限制同時進行的請求數，回傳 {航線分組鍵: 票價表 / None (失敗) / UpstreamUnavailable (延後)}
+def fetch_all_route_prices(keys):
+    def fetch(key):
+        try:
+            return fetch_route_prices(*key)
+        except UpstreamUnavailable as e:
+            return e
+
+    pool = eventlet.GreenPool(PRICE_CHECK_CONCURRENCY)
+    results = {}
+    for key, prices in zip(keys, pool.imap(fetch, keys)):
+        results[key] = prices
+    return results
+
+# === 清理過期航班 ===
+# 一個 SQL 完成：刪除出發日已過的航班，並替每筆寫入最後一則通知
+# (通知的 flight_id 直接為 NULL，等同原本 ON DELETE SET NULL 後的結果)
+def expire_departed_flights(conn):
     c = conn.cursor()
+    c.execute("""
+        WITH expired AS (
+            DELETE FROM tracked_flights
+            WHERE depart_time < CURRENT_DATE
+            RETURNING user_id, flight_number, from_airport, to_airport, depart_time, price
+        )
+        INSERT INTO notifications (flight_id, user_id, message, notify_time, price)
+        SELECT NULL, user_id,
+               format('系統通知：航班 %s (%s -> %s) 已於 %s 出發，追蹤任務結束。',
+                      flight_number, from_airport, to_airport,
+                      to_char(depart_time, 'YYYY-MM-DD HH24:MI')),
+               now(), price
+        FROM expired
+        WHERE user_id IS NOT NULL
+    """)
+    expired_count = c.rowcount
+    conn.commit()
+    c.close()
+    return expired_count
 
-    # 取得今天的日期 (格式需與資料庫中的 depart 格式一致，假設為 yyyy-MM-dd)
-    today_str = date.today().isoformat()
-    print(f"今天日期: {today_str}")
+# === 讀取指定航線的待檢查航班 ===
+# 一個 JOIN 查詢同時取得使用者的 push token (claim_jobs 已限制每批航線合計的航班數，一次讀入即可)
+# 欄位: id, user_id, from_airport, to_airport, flight_number, depart_time, price, min_price, stable_checks, expo_push_token
+def load_route_flights(conn, keys):
+    c = conn.cursor()
+    c.execute("""
+        SELECT tf.id, tf.user_id, tf.from_airport, tf.to_airport, tf.flight_number,
+               tf.depart_time, tf.price, tf.min_price, tf.stable_checks, u.expo_push_token
+        FROM tracked_flights tf
+        JOIN users u ON u.id = tf.user_id
+        WHERE tf.depart_time >= CURRENT_DATE
+          AND (upper(trim(tf.from_airport)), upper(trim(tf.to_airport)), tf.depart_time::date) IN %s
+        ORDER BY tf.id
+    """, (tuple(keys),))
+    rows = c.fetchall()
+    c.close()
+    return rows
 
-    # 先取得所有 user_id
-    c.execute("SELECT DISTINCT user_id FROM tracked_flights WHERE user_id IS NOT NULL")
-    all_users = [row[0] for row in c.fetchall()]
+# === 檢查一批航班 ===
+# route_prices: 已並行查好的 {航線分組鍵: 票價表}，依序交給 writer 寫入與通知
+def check_flight_chunk(chunk, route_prices, writer):
+    for f in chunk:
+        flight_id, user_id, from_a, to_a, flight_no, depart, old_price, old_min, stable, push_token = f
+        now = datetime.now(timezone.utc)
 
-    for user_id in all_users:
-        print(f"👤 正在檢查使用者 {user_id} 的航班...")
+        prices = route_prices.get(route_key(from_a, to_a, depart))
+        new_price = prices.get(normalize_flight_number(flight_no)) if prices is not None else None
         
-        # 取得此使用者的航班
-        c.execute("""
-            SELECT id, from_airport, to_airport, flight_number, depart_time, arrival_time, price
-            FROM tracked_flights
-            WHERE user_id = %s
-        """, (user_id,))
-        flights = c.fetchall()
-
-        for f in flights:
-            flight_id, from_a, to_a, flight_no, depart, arrive, old_price = f
-            now = datetime.now(timezone.utc).isoformat()
-
-            # 檢查航班是否過期
-            if normalize_date(depart) < today_str:
-                print(f"🗑️ 航班 {flight_no} 已過期，正在進行最後紀錄並移除...")
+        if new_price is None:
+            print(f"⚠️ {flight_no}（user {user_id}）票價更新失敗")
+            # 航線查到了但沒有這個航班，照原本的間隔延後，避免每一輪都重查整條航線
+            writer.reschedule(flight_id, now + next_check_delay(
+                depart, stable, POLL_MIN_MINUTES, POLL_MAX_MINUTES, now.replace(tzinfo=None)))
+            continue
+
+        # 票價沒變就累計穩定次數 (拉長下次檢查間隔)，有變動則歸零
+        stable = stable + 1 if new_price == old_price else 0
+        next_check_at = now + next_check_delay(
+            depart, stable, POLL_MIN_MINUTES, POLL_MAX_MINUTES, now.replace(tzinfo=None))
+
+        # 歷史最低價直接讀 tracked_flights.min_price (用於判斷是否發送低價通知)
+        # 預防 min_price 為 None，第一次加入
+        min_price = old_min if old_min is not None else new_price
+
+        # 寫入 price history，並更新 tracked_flights 的目前票價 / 最低價 / 檢查次數 / 下次檢查時間 (批次)
+        writer.add_check(flight_id, now, new_price, next_check_at, stable)
+
+        if new_price != old_price:
+            print(f"📝 {flight_no} 價格已從 {old_price} 更新為 {new_price}")
+            # 本輪結束時合併成每個使用者一則 price_update，前端不必再輪詢 /flights
+            writer.add_price_update(user_room(user_id), flight_id, {
+                "price": new_price,
+                "min_price": min(min_price, new_price)
+            })
     
-                # 1. 寫入最後一則通知訊息
-                expiry_msg = f"系統通知：航班 {flight_no} ({from_a} -> {to_a}) 已於 {depart} 出發，追蹤任務結束。"
-                c.execute("""
-                    INSERT INTO notifications (flight_id, user_id, message, notify_time, price)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (flight_id, user_id, expiry_msg, now, old_price))
+        if new_price < min_price:
+            message = (
+                f"{flight_no} 出現新低價: {new_price} TWD\n"
+                f"({from_a} -> {to_a} | 出發日期: {to_flight_time(depart)})"
+            )
+            print(f"💰 User {user_id} | {message}")
+        
+            # 寫入通知紀錄與手機推播 (同一個交易寫入 push_outbox，push token 已在同一個查詢取得)
+            writer.add_notification(flight_id, user_id, message, now, new_price)
+            if is_expo_token(push_token):
+                writer.add_push(user_id, push_token, "💰 降價提醒", message, {"type": "price_drop"})
+            # SocketIO 只推到該使用者的 room，與通知同一個交易發佈，commit 後才送出
+            writer.add_event("price_alert", {
+                "flight_number": flight_no,
+                "price": new_price
+            }, user_room(user_id))
     
-                # 2. 執行刪除
-                c.execute("DELETE FROM tracked_flights WHERE id = %s", (flight_id,))
-                conn.commit()
-                continue
-            
-            new_price = fetch_latest_price(from_a, to_a, depart, arrive, flight_no)
-            
-            if new_price is None:
-                print(f"⚠️ {flight_no}（user {user_id}）票價更新失敗")
-                continue
-
-            # 查詢歷史最低價 (用於判斷是否發送低價通知)
-            c.execute("SELECT MIN(price) FROM prices WHERE flight_id = %s", (flight_id,))
-            min_price_row = c.fetchone()
-            # 預防 min_price 為 None，第一次加入
-            min_price = min_price_row[0] if min_price_row[0] is not None else new_price
-
-            # 寫入 price history
-            c.execute("""
-                INSERT INTO prices (flight_id, checked_time, price)
-                VALUES (%s, %s, %s)
-            """, (flight_id, now, new_price))
+        elif new_price == min_price:
+            print(f"💰 User {user_id} | {flight_no} 出現歷史低價：{new_price} TWD")
+        else:
+            print(f"✈️ User {user_id} | {flight_no} 目前票價：{new_price} TWD")
+
+# === 處理一批佇列工作 ===
+# 領取最多 limit 條航線 -> 並行查詢 -> 寫入票價與通知，並在同一個交易中標記工作完成
+# 查詢失敗的航線延後重試；API 額度不足或 circuit 開啟時延後 (不算失敗)
+# updates: 本輪的 PriceUpdateCollector，commit 後票價變動併入其中，由呼叫端在整輪結束時發佈
+# 回傳本次領取的工作數 (0 = 佇列已空 / 暫停領取)
+def process_price_check_jobs(limit, updates=None):
+    # 上游故障中或剩餘額度保留給使用者查詢時先不領取
+    if rapidapi_breaker.is_open():
+        print("⏸️ RapidAPI circuit 開啟中，排程票價檢查暫緩")
+        return 0
+    if not rapidapi_budget.background_allowed():
+        print("⏸️ RapidAPI 額度偏低，排程票價檢查暫緩")
+        return 0
+
+    # 領取後立即歸還連線，等待 RapidAPI 期間不佔用連線池
+    with get_db_connection() as conn:
+        jobs = claim_jobs(conn, INSTANCE_ID, limit, PRICE_JOB_LOCK_TIMEOUT, PRICE_JOB_MAX_FLIGHTS)
+    if not jobs:
+        return 0
+
+    keys = {job[0]: route_key(job[1], job[2], job[3]) for job in jobs}
+    print(f"🔎 領取 {len(jobs)} 條航線 (並行數 {PRICE_CHECK_CONCURRENCY})")
+    started = datetime.now(timezone.utc)
+    route_prices = fetch_all_route_prices(list(dict.fromkeys(keys.values())))
+    print(f"⏱️ 航線查詢完成，耗時 {(datetime.now(timezone.utc) - started).total_seconds():.1f} 秒")
+
+    done = [job for job in jobs if isinstance(route_prices[keys[job[0]]], dict)]
+    failed = [job for job in jobs if route_prices[keys[job[0]]] is None]
+    deferred = [job for job in jobs if isinstance(route_prices[keys[job[0]]], UpstreamUnavailable)]
+    if deferred:
+        errors = [route_prices[keys[job[0]]] for job in deferred]
+        defer_delay = max(e.retry_after or PRICE_JOB_DEFER_SECONDS for e in errors)
+        defer_reason = str(errors[0])
+
+    # 票價、通知、推播與工作狀態在同一個交易 commit (writer 只在最後 flush 一次)
+    with get_db_connection() as conn:
+        writer = PriceCheckWriter(conn, batch_size=PRICE_WRITE_BATCH_SIZE, bus=socket_bus, updates=updates)
+        try:
+            if done:
+                flights = load_route_flights(conn, [(job[1], job[2], job[3]) for job in done])
+                check_flight_chunk(flights, route_prices, writer)
+
+            c = conn.cursor()
+            complete_jobs(c, [job[0] for job in done])
+            if deferred:
+                print(f"⏸️ {len(deferred)} 條航線延後 {defer_delay:.0f} 秒 ({defer_reason})")
+                defer_jobs(c, [job[0] for job in deferred], defer_delay, defer_reason)
+            for job in failed:
+                if fail_job(c, job, "航線查詢失敗", PRICE_JOB_RETRY_BASE, PRICE_JOB_RETRY_MAX, PRICE_JOB_DEAD_DELAY):
+                    print(f"☠️ 航線 {' -> '.join(keys[job[0]][:2])} {keys[job[0]][2]} 重試 {job[4]} 次仍失敗，已移至 dead")
+            c.close()
+            writer.flush()
+            conn.commit()
+        except Exception as e:
+            # 整批都已回滾：查詢成功 / 失敗的航線算一次失敗，延後的航線照樣延後 (不計入重試次數)
+            conn.rollback()
+            print(f"❌ 處理佇列工作失敗: {e}")
+            c = conn.cursor()
+            for job in done + failed:
+                fail_job(c, job, e, PRICE_JOB_RETRY_BASE, PRICE_JOB_RETRY_MAX, PRICE_JOB_DEAD_DELAY)
+            if deferred:
+                defer_jobs(c, [job[0] for job in deferred], defer_delay, defer_reason)
             conn.commit()
+            c.close()
 
-            # 價格變動 更新 tracked_flights 表中的當前價格
-            if new_price != old_price:
-                c.execute("""
-                    UPDATE tracked_flights 
-                    SET price = %s 
-                    WHERE id = %s
-                """, (new_price, flight_id))
-                print(f"📝 {flight_no} 價格已從 {old_price} 更新為 {new_price}")
-            
-            if new_price < min_price:
-                message = (
-                    f"{flight_no} 出現新低價: {new_price} TWD\n"
-                    f"({from_a} -> {to_a} | 出發日期: {depart})"
-                )
-                print(f"💰 User {user_id} | {message}")
-                
-                # 寫入通知紀錄
-                c.execute("""
-                    INSERT INTO notifications (flight_id, user_id, message, notify_time, price)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (flight_id, user_id, message, now, new_price))
-                #獲取該使用者的 Push Token (新加入)
-                c.execute("""
-                    SELECT u.expo_push_token 
-                    FROM users u
-                    JOIN tracked_flights tf ON tf.user_id = u.id
-                    WHERE tf.id = %s
-                """, (flight_id,))
-
-                result = c.fetchone()
-                user_push_token = result[0] if result else None
-
-                # 發送真正的手機系統通知
-                if user_push_token:
-                    send_push_notification(
-                        user_push_token, 
-                        "💰 降價提醒", 
-                        message
-                    )
-                conn.commit()
-                
-                # 推播到前端 —— 指定 user_id
-                socketio.emit(f"price_alert_user_{user_id}", {
-                    "flight_number": flight_no,
-                    "price": new_price
-                })               
-            
-            elif new_price == min_price:
-                print(f"💰 User {user_id} | {flight_no} 出現歷史低價：{new_price} TWD")
-            else:
-                print(f"✈️ User {user_id} | {flight_no} 目前票價：{new_price} TWD")
+    return len(jobs)
 
-    # 排程紀錄（全系統）
-    c.execute("""
-        INSERT INTO scheduler_logs (time, status)
-        VALUES (%s, %s)
-    """, (datetime.now(timezone.utc).isoformat(), "OK"))
-    conn.commit()
-    c.close()
-    conn.close()
-    
-    print("✅ 所有使用者的自動票價更新與過期清理完成")
+# 一輪結束：每個使用者的票價變動合併成一則 price_update 發佈
+def publish_price_updates(updates):
+    try:
+        sent = updates.publish(socket_bus)
+        if sent:
+            print(f"📡 已發佈 {sent} 則 price_update")
+    except Exception as e:
+        print(f"⚠️ price_update 發佈失敗: {e}")
+
+# 把佇列處理到沒有可執行的工作為止 (整個過程算一輪，price_update 結束時才發佈；
+# 累積超過 PRICE_UPDATE_MAX_DELAY 秒時先發佈一次)
+def drain_price_check_jobs():
+    updates = PriceUpdateCollector()
+    total = 0
+    try:
+        while True:
+            claimed = process_price_check_jobs(PRICE_JOB_BATCH_SIZE, updates)
+            if not claimed:
+                return total
+            total += claimed
+            if updates.due(PRICE_UPDATE_MAX_DELAY):
+                publish_price_updates(updates)
+    finally:
+        publish_price_updates(updates)
+
+# 自動檢查票價：清理過期航班，把所有航線排入佇列
+def scheduled_price_check():
+    print("🔄 開始自動檢查票價...")
+    print(f"今天日期: {date.today().isoformat()}")
+
+    with get_db_connection() as conn:
+        # 0. 先一次清理所有過期航班，之後不會再排入它們
+        expired_count = expire_departed_flights(conn)
+        if expired_count:
+            print(f"🗑️ 已移除 {expired_count} 個過期航班並寫入通知")
+
+        # 1. 依 (出發地, 目的地, 出發日期) 分組排入佇列，由 worker 並行查詢、寫入與通知
+        enqueued = enqueue_route_jobs(conn, PRICE_JOB_MAX_ATTEMPTS)
+        print(f"📥 已排入 {enqueued} 條航線的票價檢查")
+
+        # 排程紀錄（全系統）
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO scheduler_logs (time, status)
+            VALUES (%s, %s)
+        """, (datetime.now(timezone.utc), f"OK ({enqueued} 條航線排入佇列)"))
+        conn.commit()
+        c.close()
+
+# 多個 instance 都會觸發排程，透過 advisory lock 讓每個時段只排入一次；
+# 各 instance 的內建 worker 再以 SKIP LOCKED 一起消化佇列
+def run_price_check():
+    ran = run_exclusive(db_pool, "price_check", PRICE_CHECK_INTERVAL_MINUTES * 60, scheduled_price_check)
+    if not ran:
+        print("⏭️ 本時段的票價檢查已由其他 instance 排入")
+
+    if PRICE_WORKER_EMBEDDED:
+        processed = drain_price_check_jobs()
+        print(f"✅ 本 instance 完成 {processed} 條航線的票價檢查")
+
+# === 獨立 worker (python app.py worker) ===
+# 不啟動 Flask / SocketIO，只持續領取佇列工作；佇列空了就稍等再查
+def run_price_worker():
+    print(f"👷 票價檢查 worker 啟動 ({INSTANCE_ID})")
+    updates = PriceUpdateCollector()
+    while True:
+        try:
+            claimed = process_price_check_jobs(PRICE_JOB_BATCH_SIZE, updates)
+            # 佇列已空 = 一輪結束；一直有工作時也不讓前端等太久
+            if not claimed or updates.due(PRICE_UPDATE_MAX_DELAY):
+                publish_price_updates(updates)
+            if not claimed:
+                eventlet.sleep(PRICE_WORKER_IDLE_SECONDS)
+        except Exception as e:
+            print(f"⚠️ worker 發生錯誤: {e}")
+            eventlet.sleep(PRICE_WORKER_IDLE_SECONDS)
+
+# 票價歷史彙總與保留期限：原始資料 -> 每小時 -> 每日，再刪除超過保留天數的資料
+# 例外交給 run_exclusive 記錄為 ERROR (見 /debug/scheduler)
+def rollup_price_history():
+    with get_db_connection() as conn:
+        created = ensure_partitions(conn, PRICE_PARTITION_MONTHS_AHEAD)
+        if created:
+            print(f"🧱 已建立票價分區: {', '.join(created)}")
+        hourly = rollup_hourly(conn)
+        daily = rollup_daily(conn)
+        deleted = apply_retention(conn, PRICE_RAW_RETENTION_DAYS, PRICE_HOURLY_RETENTION_DAYS)
+        tombstones = purge_tombstones(conn, SYNC_TOMBSTONE_DAYS)
+    print(f"📊 票價彙總完成：每小時 {hourly} 筆、每日 {daily} 筆；"
+          f"移除原始分區 {len(deleted['raw_partitions'])} 個、每小時 {deleted['hourly']} 筆、同步刪除紀錄 {tombstones} 筆")
+
+def run_price_rollup():
+    run_exclusive(db_pool, "price_rollup", 3600, rollup_price_history)
 
 def keep_alive():
     try:
@@ -820,6 +1380,15 @@ def keep_alive():
 # 正式啟動後端（eventlet + SocketIO）
 # ==============================================
 if __name__ == "__main__":
+    # 獨立 worker：python app.py worker
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        init_all_tables()
+        db_pool.warmup()
+        if PUSH_DISPATCHER_ENABLED:
+            eventlet.spawn_n(push_dispatcher.run_forever, PUSH_DISPATCH_INTERVAL, receipt_delay=PUSH_RECEIPT_DELAY)
+        run_price_worker()
+        sys.exit(0)
+
     port = int(os.environ.get("PORT", 10000))
     print(f"🚀 使用 eventlet 啟動 SocketIO Server，埠號：{port}")
     
@@ -827,6 +1396,8 @@ if __name__ == "__main__":
     #drop_all_tables()
     # 在啟動伺服器前先檢查並建立資料表
     init_all_tables()
+    # 預先建立最小數量的連線
+    db_pool.warmup()
 
     # 取得當前是否為 Debug 模式
     is_debug = False
@@ -836,10 +1407,20 @@ if __name__ == "__main__":
         scheduler = BackgroundScheduler()
         # 每11分鐘戳自己一下，防止render休眠 (15mins)
         scheduler.add_job(keep_alive, "interval", minutes=11)
-        # 檢查機票
-        scheduler.add_job(scheduled_price_check, "interval", minutes=60)
+        # 檢查機票：各 instance 對齊在同一時間觸發，一起消化佇列
+        # (間隔超過一小時時每小時觸發，由 job_runs 的時段判斷跳過)
+        check_minute = f"*/{PRICE_CHECK_INTERVAL_MINUTES}" if PRICE_CHECK_INTERVAL_MINUTES < 60 else 0
+        scheduler.add_job(run_price_check, "cron", minute=check_minute)
+        # 票價歷史彙總與保留期限
+        scheduler.add_job(run_price_rollup, "cron", minute=30)
         scheduler.start()
         print("🕒 APScheduler 已啟動")
 
+    # 背景發送推播
+    if PUSH_DISPATCHER_ENABLED:
+        eventlet.spawn_n(push_dispatcher.run_forever, PUSH_DISPATCH_INTERVAL, receipt_delay=PUSH_RECEIPT_DELAY)
+    # 接收所有 process 發佈的 SocketIO 事件
+    eventlet.spawn_n(socket_bus.listen_forever, deliver_socket_event)
+
     # 用socketio.run
     socketio.run(app, host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
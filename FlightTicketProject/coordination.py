@@ -0,0 +1,92 @@
+# === 多 instance 排程協調 (PostgreSQL advisory lock) ===
+# 每個 instance 都會觸發排程，但同一個工作在每個時段只會執行一次：
+# 1. pg_try_advisory_lock 保證同一時間只有一個 instance 在跑
+# 2. job_runs 記錄已執行到哪個時段，同一時段的後續觸發直接跳過
+import os
+import socket
+import time
+import zlib
+
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def job_lock_key(job):
+    """工作名稱 -> advisory lock 的第一個 int4 key"""
+    key = zlib.crc32(job.encode("utf-8"))
+    return key - (1 << 32) if key >= (1 << 31) else key
+
+
+def current_slot(interval_seconds):
+    return int(time.time() // interval_seconds)
+
+
+def _claim_slot(c, job, slot):
+    """本時段尚未有人執行時記錄由本 instance 執行，回傳是否取得"""
+    c.execute("""
+        INSERT INTO job_runs (job, slot, owner, started_at, finished_at, status)
+        VALUES (%s, %s, %s, now(), NULL, 'RUNNING')
+        ON CONFLICT (job) DO UPDATE SET
+            slot = EXCLUDED.slot,
+            owner = EXCLUDED.owner,
+            started_at = EXCLUDED.started_at,
+            finished_at = NULL,
+            status = EXCLUDED.status
+        WHERE job_runs.slot < EXCLUDED.slot
+        RETURNING 1
+    """, (job, slot, INSTANCE_ID))
+    return c.fetchone() is not None
+
+
+def _finish_slot(c, job, status):
+    c.execute("""
+        UPDATE job_runs SET finished_at = now(), status = %s
+        WHERE job = %s AND owner = %s
+    """, (status[:500], job, INSTANCE_ID))
+
+
+def run_exclusive(pool, job, interval_seconds, fn):
+    """
+    拿到 advisory lock 且本時段尚未執行才呼叫 fn()
+    回傳本 instance 是否執行了 fn
+    """
+    slot = current_slot(interval_seconds)
+    lock_key = job_lock_key(job)
+
+    # 鎖是 session 層級，整段執行期間占用這條連線
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT pg_try_advisory_lock(%s)", (lock_key,))
+        locked = c.fetchone()[0]
+        conn.commit()
+        if not locked:
+            c.close()
+            return False
+
+        try:
+            claimed = _claim_slot(c, job, slot)
+            conn.commit()
+            if not claimed:
+                return False
+
+            status = "OK"
+            try:
+                fn()
+            except Exception as e:
+                status = f"ERROR: {e}"
+                print(f"❌ 排程 {job} 失敗: {e}")
+            _finish_slot(c, job, status)
+            conn.commit()
+            return True
+        finally:
+            conn.rollback()
+            c.execute("SELECT pg_advisory_unlock(%s)", (lock_key,))
+            conn.commit()
+            c.close()
+
+
+def job_run_status(c):
+    c.execute("""
+        SELECT job, slot, owner, started_at, finished_at, status
+        FROM job_runs ORDER BY job
+    """)
+    return c.fetchall()
@@ -0,0 +1,230 @@
+# === PostgreSQL 連線池 ===
+# 取代每個 API 都 psycopg2.connect() 一次的作法：
+# 連線建立一次後重複使用，省下每次 TCP + TLS + 認證的握手時間。
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+
+# ------------------------------------
+# 讓 psycopg2 在 eventlet 下不會卡住整個 hub (等同 psycogreen)
+# psycopg2 是 C 擴充，monkey_patch 管不到，需要註冊 wait callback
+def make_psycopg_green():
+    extensions.set_wait_callback(_eventlet_wait_callback)
+
+
+def _eventlet_wait_callback(conn, timeout=-1):
+    from eventlet.hubs import trampoline
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            trampoline(conn.fileno(), read=True)
+        elif state == extensions.POLL_WRITE:
+            trampoline(conn.fileno(), write=True)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """等待可用連線超過 timeout"""
+
+
+class ConnectionPool:
+    """
+    有上下限的連線池
+    - minconn: 啟動時預先建立的連線數
+    - maxconn: 同時借出的連線上限，滿了就排隊等待
+    - health_check_after: 閒置超過幾秒的連線，借出前先 SELECT 1 確認還活著
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=30,
+                 health_check_after=30, max_lifetime=3600):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("連線池大小設定錯誤 (需 0 <= min <= max 且 max >= 1)")
+
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.max_lifetime = max_lifetime
+
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, 歸還時間)] (建立時間記在 _created_at)
+        self._created_at = {}    # id(conn) -> 建立時間
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        # 統計數據
+        self._stats = {
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "checkouts": 0,
+            "health_checks": 0,
+            "health_check_failures": 0,
+            "timeouts": 0,
+            "wait_time_total": 0.0,
+        }
+
+    # ------------------------------------
+    # 預先建立 minconn 條連線
+    def warmup(self):
+        for _ in range(self.minconn):
+            conn = self._connect()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        with self._cond:
+            self._created_at[id(conn)] = time.monotonic()
+            self._stats["connections_created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._stats["connections_discarded"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        born = self._created_at.get(id(conn), 0)
+        if self.max_lifetime and time.monotonic() - born > self.max_lifetime:
+            return False
+        if time.monotonic() - idle_since < self.health_check_after:
+            return True
+
+        # 閒置太久，先確認連線沒有被伺服器或防火牆切斷
+        with self._cond:
+            self._stats["health_checks"] += 1
+        try:
+            c = conn.cursor()
+            c.execute("SELECT 1")
+            c.close()
+            conn.rollback()
+            return True
+        except Exception:
+            with self._cond:
+                self._stats["health_check_failures"] += 1
+            return False
+
+    # ------------------------------------
+    # 借出連線
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.InterfaceError("連線池已關閉")
+
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    self._in_use += 1
+                    action = "reuse"
+                elif self._in_use + len(self._idle) < self.maxconn:
+                    self._in_use += 1
+                    action = "create"
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"等待資料庫連線逾時 ({self.timeout}s, max={self.maxconn})"
+                        )
+                    self._waiting += 1
+                    self._cond.wait(remaining)
+                    self._waiting -= 1
+                    continue
+
+            # 建立連線 / 健康檢查都在鎖外進行，避免卡住其他人
+            try:
+                if action == "create":
+                    conn = self._connect()
+                elif not self._is_healthy(conn, idle_since):
+                    self._discard(conn)
+                    conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+
+            with self._cond:
+                self._stats["checkouts"] += 1
+                self._stats["wait_time_total"] += time.monotonic() - start
+            return conn
+
+    # ------------------------------------
+    # 歸還連線
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                # 沒 commit 的交易一律 rollback，下一個借用者拿到乾淨的連線
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard or conn.closed or self._closed:
+            self._discard(conn)
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            return
+
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """with pool.connection() as conn: ... 離開時自動歸還 (例外時 rollback)"""
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, discard=broken)
+
+    def stats(self):
+        with self._cond:
+            data = dict(self._stats)
+            data.update({
+                "min": self.minconn,
+                "max": self.maxconn,
+                "size": self._in_use + len(self._idle),
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+            })
+        data["wait_time_avg_ms"] = round(
+            data["wait_time_total"] * 1000 / data["checkouts"], 2
+        ) if data["checkouts"] else 0.0
+        data["wait_time_total"] = round(data["wait_time_total"], 3)
+        return data
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
@@ -0,0 +1,81 @@
+# === 折線圖降採樣 ===
+# points: [(time, price), ...] 依時間排序
+# 回傳不超過 n 個點、依時間排序，第一個與最後一個點一定保留
+
+
+def minmax_downsample(points, n):
+    """
+    切成 n/2 個時間桶，每桶保留最低價與最高價
+    票價低點一定會留下來 (降價通知在意的就是低點)
+    """
+    if n <= 0 or len(points) <= n:
+        return list(points)
+    if n < 4:
+        return [points[0], points[-1]][:n]
+
+    first, last = points[0], points[-1]
+    inner = points[1:-1]
+    buckets = (n - 2) // 2
+    size = len(inner) / buckets
+
+    result = [first]
+    for b in range(buckets):
+        bucket = inner[int(b * size):int((b + 1) * size)]
+        if not bucket:
+            continue
+        low = min(bucket, key=lambda p: p[1])
+        high = max(bucket, key=lambda p: p[1])
+        if low is high:
+            result.append(low)
+        else:
+            result.extend(sorted((low, high), key=lambda p: p[0]))
+    result.append(last)
+    return result
+
+
+def lttb_downsample(points, n):
+    """Largest-Triangle-Three-Buckets：保留視覺上最明顯的轉折點"""
+    if n <= 0 or len(points) <= n:
+        return list(points)
+    if n < 3:
+        return [points[0], points[-1]][:n]
+
+    xs = [p[0].timestamp() for p in points]
+    ys = [p[1] for p in points]
+    size = (len(points) - 2) / (n - 2)
+
+    result = [points[0]]
+    a = 0
+    for i in range(n - 2):
+        start = int(i * size) + 1
+        end = int((i + 1) * size) + 1
+
+        # 下一個桶的平均點
+        next_start = end
+        next_end = min(int((i + 2) * size) + 1, len(points))
+        if next_start >= next_end:
+            avg_x, avg_y = xs[-1], ys[-1]
+        else:
+            avg_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+            avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+
+        # 本桶中與 (上一個選中點, 下一桶平均點) 面積最大的點
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs(
+                (xs[a] - avg_x) * (ys[j] - ys[a]) -
+                (xs[a] - xs[j]) * (avg_y - ys[a])
+            )
+            if area > best_area:
+                best, best_area = j, area
+        result.append(points[best])
+        a = best
+
+    result.append(points[-1])
+    return result
+
+
+DOWNSAMPLERS = {
+    "minmax": minmax_downsample,
+    "lttb": lttb_downsample,
+}
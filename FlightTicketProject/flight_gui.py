@@ -9,7 +9,7 @@ from PyQt5.QtWidgets import (
     QTableWidget, QTableWidgetItem, QMessageBox, QHeaderView, QTabWidget,
     QHBoxLayout, QDateEdit, QCheckBox, QFrame
 )
-from PyQt5.QtCore import Qt, QDate, QUrl
+from PyQt5.QtCore import Qt, QDate, QUrl, pyqtSignal
 from PyQt5.QtGui import QIcon, QDesktopServices
 from matplotlib import pyplot as plt
 from pathlib import Path
@@ -30,6 +30,8 @@ os.environ["SSL_CERT_FILE"] = certifi.where() # SSL 憑證
 APP_NAME = "FlightTicketTracker"
 ICON_PATH = resource_path("app_icon.png")
 API_URL = "https://flightticketproject.onrender.com"
+NOTIFY_PAGE_SIZE = 50   # 通知紀錄每次載入筆數
+CHART_POINTS = 300      # 折線圖最多畫幾個點 (由伺服器降採樣)
 
 def get_app_dir():
     base = Path.home() / f".{APP_NAME}"
@@ -47,12 +49,17 @@ def app_data_dir():
 
 # --- 主類別 ---
 class FlightApp(QWidget):
+    # SocketIO 在背景 thread 收到事件，透過 signal 交給 UI thread 更新表格
+    price_update_received = pyqtSignal(dict)
+
     def __init__(self):
         super().__init__()
 
         self.token = None
         self.user_id = None
         self.sio = None
+        self.tracked_rows = {}  # flight_id -> 追蹤表格的列
+        self.price_update_received.connect(self.apply_price_update)
 
         self.setWindowTitle(f"{APP_NAME} v{APP_VERSION}")
         self.setGeometry(200, 200, 900, 600)
@@ -358,7 +365,7 @@ class FlightApp(QWidget):
 
 
     # -------------------------------------------------
-    # SocketIO：登入後依 user_id 訂閱 price_alert_user_xxx
+    # SocketIO：登入後帶 JWT 連線，伺服器只會把自己的通知送到自己的 room
     # -------------------------------------------------
     def init_socket(self, user_id):
         self.sio = socketio.Client(
@@ -367,9 +374,7 @@ class FlightApp(QWidget):
             reconnection_delay=2
         )
 
-        event_name = f"price_alert_user_{self.user_id}"
-
-        @self.sio.on(event_name)
+        @self.sio.on("price_alert")
         def on_price_alert(data):
             flight = data["flight_number"]
             price = data["price"]
@@ -386,12 +391,17 @@ class FlightApp(QWidget):
                 f"{flight} 出現新低價：{price} TWD"
                 )
 
+        @self.sio.on("price_update")
+        def on_price_update(data):
+            self.price_update_received.emit(data)
+
         try:
             self.sio.connect(
                 API_URL,
+                auth={"token": self.token},
                 transports=["websocket", "polling"]
             )
-            print(f"🔌 SocketIO connected: {event_name}")
+            print(f"🔌 SocketIO connected: user {user_id}")
         except Exception as e:
             print("❌ SocketIO 連線錯誤：", e)
                 
@@ -565,6 +575,14 @@ class FlightApp(QWidget):
         self.notify_table.setColumnWidth(0, 160)
         
         layout.addWidget(self.notify_table)
+
+        # 分頁：往下載入更舊的通知
+        self.notify_next_cursor = None
+        self.notify_more_btn = QPushButton("載入更多")
+        self.notify_more_btn.clicked.connect(self.load_more_notifications)
+        self.notify_more_btn.setEnabled(False)
+        layout.addWidget(self.notify_more_btn)
+
         self.notify_tab.setLayout(layout)
 
 
@@ -664,6 +682,7 @@ class FlightApp(QWidget):
             # ⭐ 關鍵：先清空表格
             self.tracked_table.clearContents()
             self.tracked_table.setRowCount(0)
+            self.tracked_rows = {}
 
             if not data:
                 QMessageBox.information(self, "提示", "目前沒有追蹤中的航班")
@@ -678,6 +697,7 @@ class FlightApp(QWidget):
                 self.tracked_table.setItem(i, 3, QTableWidgetItem(f["arrival_time"]))
                 self.tracked_table.setItem(i, 4, QTableWidgetItem(str(f["price"])))
                 self.tracked_table.setItem(i, 5, QTableWidgetItem(f["from"]))
+                self.tracked_rows[f["id"]] = i
 
                 # 刪除按鈕
                 btn_layout = QHBoxLayout()
@@ -705,6 +725,15 @@ class FlightApp(QWidget):
             QMessageBox.critical(self, "錯誤", f"無法載入追蹤清單: {e}")
 
 
+    # -------------------------------------------------
+    # 伺服器推送的票價變動 (price_update)：直接更新表格，不必重新載入
+    # -------------------------------------------------
+    def apply_price_update(self, data):
+        for f in data.get("flights", []):
+            row = self.tracked_rows.get(f.get("id"))
+            if row is not None:
+                self.tracked_table.setItem(row, 4, QTableWidgetItem(str(f["price"])))
+
     # -------------------------------------------------
     # 刪除航班（DELETE /flights/<id>）
     # -------------------------------------------------
@@ -731,12 +760,16 @@ class FlightApp(QWidget):
     def show_price_chart(self, flight_id, flight_number):
         url = f"{API_URL}/prices/{flight_id}"
         try:
-            response = requests.get(url, headers=self.auth())
+            # 由伺服器降採樣，資料量固定不隨追蹤時間變大
+            response = requests.get(url, params={"points": CHART_POINTS}, headers=self.auth())
             if response.status_code != 200:
                 QMessageBox.warning(self, "提示", "此航班目前沒有票價紀錄")
                 return
 
-            data = response.json()
+            data = response.json()["items"]
+            if not data:
+                QMessageBox.warning(self, "提示", "此航班目前沒有票價紀錄")
+                return
             # --- 時間格式化處理 ---
             times = []
             prices = []
@@ -778,12 +811,24 @@ class FlightApp(QWidget):
         )
 
     # -------------------------------------------------
-    # 載入通知
+    # 載入通知 (分頁，第一頁為最新的通知)
     # -------------------------------------------------
     def load_notifications(self):
+        self.notify_table.setRowCount(0)
+        self.notify_next_cursor = None
+        self.fetch_notification_page(show_empty_hint=True)
+
+    def load_more_notifications(self):
+        if self.notify_next_cursor:
+            self.fetch_notification_page(before=self.notify_next_cursor)
+
+    def fetch_notification_page(self, before=None, show_empty_hint=False):
         try:
             url = f"{API_URL}/notifications"
-            response = requests.get(url, headers=self.auth())  # ✅ 加上 headers
+            params = {"limit": NOTIFY_PAGE_SIZE}
+            if before:
+                params["before"] = before
+            response = requests.get(url, params=params, headers=self.auth())  # ✅ 加上 headers
 
             if response.status_code != 200:
                 QMessageBox.warning(self, "錯誤", f"伺服器回傳錯誤：{response.text}")
@@ -791,17 +836,22 @@ class FlightApp(QWidget):
             
             data = response.json()
             
-            if not isinstance(data, list):
-                QMessageBox.warning(self, "錯誤", f"伺服器回傳非清單：{data}")
+            if not isinstance(data, dict) or not isinstance(data.get("items"), list):
+                QMessageBox.warning(self, "錯誤", f"伺服器回傳格式錯誤：{data}")
                 return
 
-            if not data:
+            items = data["items"]
+            self.notify_next_cursor = data.get("next_cursor")
+            self.notify_more_btn.setEnabled(bool(self.notify_next_cursor))
+
+            if not items and show_empty_hint:
                 QMessageBox.information(self, "提示", "目前沒有通知紀錄")
                 return
 
-            self.notify_table.setRowCount(len(data))
+            start = self.notify_table.rowCount()
+            self.notify_table.setRowCount(start + len(items))
             
-            for i, n in enumerate(data):
+            for i, n in enumerate(items, start=start):
                 dt_utc = datetime.fromisoformat(n["time"].replace('Z', '+00:00'))
                 # 轉換為本地時區 (手機/電腦系統當前的時區)
                 dt_local = dt_utc.astimezone() 
@@ -0,0 +1,145 @@
+# === 票價檢查工作佇列 (price_check_jobs) ===
+# 每次排程把需要查詢的航線 (出發地, 目的地, 出發日期) 寫入佇列，一條航線一個工作；
+# worker 以 FOR UPDATE SKIP LOCKED 領取，多個 process / 機器可同時處理而不會拿到同一筆。
+# 失敗時依次數指數延後重試，超過 max_attempts 標記為 dead 留待人工檢查，
+# 同時把該航線航班的 next_check_at 延後，避免下一輪排程立刻又排入同一條航線。
+# 狀態: pending -> running -> done / (失敗) pending ... -> dead
+# 航班以 upper(trim(出發地/目的地)) 與 depart_time::date 對應航線，由 tracked_flights_route_idx 索引 (運算式需保持一致)
+import random
+
+
+def enqueue_route_jobs(conn, max_attempts, keep_days=7):
+    """
+    把有航班已到下次檢查時間的航線排入佇列 (已在佇列中的航線不重複排入)，回傳新增的工作數
+    同一條航線只要查一次，會一起更新該航線上的所有航班
+    """
+    c = conn.cursor()
+    c.execute("""
+        INSERT INTO price_check_jobs (from_airport, to_airport, depart_date, max_attempts)
+        SELECT DISTINCT upper(trim(from_airport)), upper(trim(to_airport)), depart_time::date, %s
+        FROM tracked_flights
+        WHERE depart_time >= CURRENT_DATE
+          AND (next_check_at IS NULL OR next_check_at <= now())
+        ON CONFLICT (from_airport, to_airport, depart_date)
+            WHERE status IN ('pending', 'running') DO NOTHING
+    """, (max_attempts,))
+    enqueued = c.rowcount
+
+    # 已完成的工作只保留一段時間；dead 保留給人工檢查
+    c.execute("""
+        DELETE FROM price_check_jobs
+        WHERE status = 'done' AND finished_at < now() - %s * interval '1 day'
+    """, (keep_days,))
+    conn.commit()
+    c.close()
+    return enqueued
+
+
+def claim_jobs(conn, worker, limit, lock_timeout, max_flights):
+    """
+    領取最多 limit 個可執行的工作 (含 worker 當掉、超過 lock_timeout 秒仍在 running 的工作)
+    依序累計各航線的航班數，超過 max_flights 後的航線留給下一次 (至少領取一條)，讓每批讀入的航班數有上限
+    回傳 [(id, from_airport, to_airport, depart_date, attempts, max_attempts)]
+    """
+    c = conn.cursor()
+    c.execute("""
+        WITH candidates AS (
+            SELECT id, from_airport, to_airport, depart_date, available_at
+            FROM price_check_jobs
+            WHERE (status = 'pending' AND available_at <= now())
+               OR (status = 'running' AND locked_at < now() - %s * interval '1 second')
+            ORDER BY available_at, id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ), sized AS (
+            SELECT cj.id,
+                   SUM(COUNT(tf.id)) OVER (ORDER BY cj.available_at, cj.id) - COUNT(tf.id) AS flights_before
+            FROM candidates AS cj
+            LEFT JOIN tracked_flights AS tf
+                ON upper(trim(tf.from_airport)) = cj.from_airport
+               AND upper(trim(tf.to_airport)) = cj.to_airport
+               AND tf.depart_time::date = cj.depart_date
+               AND tf.depart_time >= CURRENT_DATE
+            GROUP BY cj.id, cj.available_at
+        )
+        UPDATE price_check_jobs AS j
+        SET status = 'running', locked_by = %s, locked_at = now(), attempts = j.attempts + 1
+        FROM sized
+        WHERE j.id = sized.id AND sized.flights_before < %s
+        RETURNING j.id, j.from_airport, j.to_airport, j.depart_date, j.attempts, j.max_attempts
+    """, (lock_timeout, limit, worker, max_flights))
+    jobs = c.fetchall()
+    conn.commit()
+    c.close()
+    return jobs
+
+
+def complete_jobs(c, job_ids):
+    """標記完成 (不 commit，與票價寫入在同一個交易)"""
+    if not job_ids:
+        return
+    c.execute("""
+        UPDATE price_check_jobs
+        SET status = 'done', finished_at = now(), locked_by = NULL, last_error = NULL
+        WHERE id = ANY(%s)
+    """, (list(job_ids),))
+
+
+def defer_jobs(c, job_ids, delay, reason):
+    """暫時不能執行 (例如 API 額度保留給使用者)：延後 delay 秒，不計入重試次數 (不 commit)"""
+    if not job_ids:
+        return
+    c.execute("""
+        UPDATE price_check_jobs
+        SET status = 'pending', locked_by = NULL, attempts = attempts - 1,
+            available_at = now() + %s * interval '1 second', last_error = %s
+        WHERE id = ANY(%s)
+    """, (delay, reason[:500], list(job_ids)))
+
+
+def retry_delay(attempts, base, cap):
+    """第 n 次失敗後的等待秒數：base * 2^(n-1)，上限 cap，加上隨機抖動避免同時重試"""
+    delay = min(cap, base * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def fail_job(c, job, error, base, cap, dead_delay):
+    """
+    失敗：還有次數就延後重試，否則標記為 dead，並把航線上航班的下次檢查延後 dead_delay 秒 (不 commit)
+    回傳是否已進入 dead
+    """
+    job_id, attempts, max_attempts = job[0], job[4], job[5]
+    if attempts >= max_attempts:
+        c.execute("""
+            UPDATE price_check_jobs
+            SET status = 'dead', finished_at = now(), locked_by = NULL, last_error = %s
+            WHERE id = %s
+        """, (str(error)[:500], job_id))
+        c.execute("""
+            UPDATE tracked_flights
+            SET next_check_at = now() + %s * interval '1 second'
+            WHERE upper(trim(from_airport)) = %s AND upper(trim(to_airport)) = %s
+              AND depart_time::date = %s
+        """, (dead_delay, job[1], job[2], job[3]))
+        return True
+
+    c.execute("""
+        UPDATE price_check_jobs
+        SET status = 'pending', locked_by = NULL,
+            available_at = now() + %s * interval '1 second', last_error = %s
+        WHERE id = %s
+    """, (retry_delay(attempts, base, cap), str(error)[:500], job_id))
+    return False
+
+
+def queue_stats(c):
+    c.execute("SELECT status, COUNT(*) FROM price_check_jobs GROUP BY status")
+    counts = {status: count for status, count in c.fetchall()}
+    c.execute("""
+        SELECT id, from_airport, to_airport, depart_date, attempts, last_error, finished_at
+        FROM price_check_jobs
+        WHERE status = 'dead'
+        ORDER BY finished_at DESC
+        LIMIT 20
+    """)
+    return counts, c.fetchall()
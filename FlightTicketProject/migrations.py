@@ -0,0 +1,816 @@
+# === 資料庫版本遷移 ===
+# 每個 migration 有固定版本號，套用後記錄在 schema_migrations，
+# 啟動時只執行還沒套用過的版本；已是最新版時只需一次查詢。
+import time
+from datetime import datetime, timezone
+
+from partitions import DEFAULT_MONTHS_AHEAD, LEGACY_PARTITION, add_months, create_partition, month_start
+
+# 多個 instance 同時啟動時，只讓一個執行 migration
+MIGRATION_LOCK_ID = 724301
+MIGRATION_LOCK_POLL_SECONDS = 1
+
+MIGRATIONS = []  # [(version, name, fn, transactional)]
+
+
+def migration(version, name, transactional=True):
+    """
+    註冊 migration
+    transactional=True: fn(cursor) 在單一交易內執行，成功後與版本紀錄一起 commit
+    transactional=False: fn(conn) 自行控制 commit (例如分批回填、CREATE INDEX CONCURRENTLY)
+    """
+    def decorator(fn):
+        MIGRATIONS.append((version, name, fn, transactional))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(c):
+    c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return c.fetchone()[0]
+
+
+def acquire_migration_lock(conn):
+    """
+    取得 migration lock (session 層級)
+    等待時不能停在交易中：持有 snapshot 的等待者會讓持有 lock 的 instance 的
+    CREATE INDEX CONCURRENTLY 一直等它，形成 deadlock。因此在 autocommit 下輪詢 pg_try_advisory_lock
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    c = conn.cursor()
+    try:
+        waited = False
+        while True:
+            c.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            if c.fetchone()[0]:
+                return
+            if not waited:
+                print("⏳ 其他 instance 正在執行 migration，等待中...")
+                waited = True
+            time.sleep(MIGRATION_LOCK_POLL_SECONDS)
+    finally:
+        c.close()
+        conn.autocommit = autocommit
+
+
+def run_migrations(conn):
+    """套用所有尚未執行的 migration，回傳本次套用的版本清單"""
+    c = conn.cursor()
+    try:
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+        conn.commit()
+
+        # 已是最新版本 → 直接跳過
+        if current_version(c) >= latest_version():
+            conn.commit()
+            return []
+
+        acquire_migration_lock(conn)
+        try:
+            c.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in c.fetchall()}
+            conn.commit()
+
+            done = []
+            for version, name, fn, transactional in MIGRATIONS:
+                if version in applied:
+                    continue
+
+                print(f"🛠️ 套用 migration {version:03d}: {name}")
+                try:
+                    if transactional:
+                        fn(c)
+                    else:
+                        fn(conn)
+                    c.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                        (version, name)
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                done.append(version)
+            return done
+        finally:
+            c.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            conn.commit()
+    finally:
+        c.close()
+
+
+# ==============================================
+# Migrations
+# ==============================================
+
+@migration(1, "baseline tables")
+def m001_baseline(c):
+    # 1. Users
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TEXT,
+            expo_push_token TEXT
+        )
+    """)
+
+    # 2. Tracked Flights
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS tracked_flights (
+            id SERIAL PRIMARY KEY,
+            from_airport TEXT,
+            to_airport TEXT,
+            flight_number TEXT,
+            airline TEXT,
+            depart_time TEXT,
+            arrival_time TEXT,
+            price DOUBLE PRECISION,
+            user_id INTEGER REFERENCES users(id)
+        )
+    """)
+
+    # 3. Notifications
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS notifications (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            flight_id INTEGER REFERENCES tracked_flights(id) ON DELETE SET NULL,
+            notify_time TEXT,
+            price DOUBLE PRECISION,
+            message TEXT
+        )
+    """)
+
+    # 4. Scheduler Logs
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS scheduler_logs (
+            id SERIAL PRIMARY KEY,
+            time TEXT,
+            status TEXT
+        )
+    """)
+
+    # 5. Prices
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS prices (
+            id SERIAL PRIMARY KEY,
+            flight_id INTEGER REFERENCES tracked_flights(id) ON DELETE CASCADE,
+            checked_time TEXT,
+            price DOUBLE PRECISION
+        )
+    """)
+
+
+@migration(2, "tracked_flights running min price")
+def m002_running_min_price(c):
+    # 舊資料表補上歷史最低價 / 最後檢查時間 / 檢查次數
+    c.execute("""
+        ALTER TABLE tracked_flights
+            ADD COLUMN IF NOT EXISTS min_price DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS last_checked_at TEXT,
+            ADD COLUMN IF NOT EXISTS check_count INTEGER NOT NULL DEFAULT 0
+    """)
+
+    # 從 prices 回填尚未計算的歷史最低價
+    c.execute("""
+        UPDATE tracked_flights tf
+        SET min_price = p.min_price,
+            last_checked_at = p.last_checked_at,
+            check_count = p.check_count
+        FROM (
+            SELECT flight_id, MIN(price) AS min_price,
+                   MAX(checked_time) AS last_checked_at, COUNT(*) AS check_count
+            FROM prices
+            GROUP BY flight_id
+        ) p
+        WHERE tf.id = p.flight_id AND tf.min_price IS NULL
+    """)
+
+
+@migration(3, "indexes and tracked flight unique constraint")
+def m003_indexes(c):
+    # 先清掉以前 check-then-insert 競爭條件留下的重複追蹤 (保留最早的一筆)
+    c.execute("""
+        DELETE FROM tracked_flights a
+        USING tracked_flights b
+        WHERE a.user_id = b.user_id
+          AND a.flight_number = b.flight_number
+          AND a.depart_time = b.depart_time
+          AND a.id > b.id
+    """)
+
+    # 同 user、同航班號、同出發時間只能追蹤一次
+    # (user_id 為最左欄位，也同時涵蓋 WHERE user_id = %s 的查詢，不另建 tracked_flights(user_id))
+    c.execute("""
+        ALTER TABLE tracked_flights
+        ADD CONSTRAINT tracked_flights_user_flight_depart_key
+        UNIQUE (user_id, flight_number, depart_time)
+    """)
+
+    # 票價歷史：依航班查詢並依時間排序
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS prices_flight_id_checked_time_idx
+        ON prices (flight_id, checked_time)
+    """)
+
+    # 通知紀錄：依使用者查詢並依時間排序
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS notifications_user_id_notify_time_idx
+        ON notifications (user_id, notify_time)
+    """)
+
+    # 排程紀錄：ORDER BY time DESC LIMIT 20
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS scheduler_logs_time_idx
+        ON scheduler_logs (time)
+    """)
+
+
+# ------------------------------------
+# 線上轉換欄位型別 (TEXT -> 時間型別)
+# 1. 新增 <column>__new 影子欄位，trigger 讓轉換期間的新寫入同步過去
+# 2. 依 id 分批回填，每批各自 commit，不長時間鎖表
+# 3. CREATE INDEX CONCURRENTLY 先在影子欄位建好索引
+# 4. 短交易內補齊差異、移除舊欄位、改名
+# 中途失敗可直接重跑，已完成的欄位會略過
+BACKFILL_BATCH_SIZE = 5000
+
+
+def _column_type(c, table, column):
+    c.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def convert_column(conn, table, column, sql_type, data_type, cast_fn, indexes=()):
+    """
+    sql_type: 目標型別 (例如 TIMESTAMPTZ)
+    data_type: information_schema 中的型別名稱，用來判斷是否已經轉換過
+    cast_fn: 轉換用的 SQL 函式名稱 (無法解析的值回傳 NULL)
+    indexes: [(索引名稱, 欄位定義 (用 {col} 代表此欄位), unique constraint 名稱或 None)]
+    """
+    c = conn.cursor()
+    shadow = f"{column}__new"
+    sync_fn = f"{table}_{column}_sync"
+
+    if _column_type(c, table, column) == data_type:
+        conn.commit()
+        c.close()
+        return
+
+    # 1. 影子欄位 + 同步 trigger
+    c.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {shadow} {sql_type}")
+    c.execute(f"""
+        CREATE OR REPLACE FUNCTION {sync_fn}() RETURNS trigger AS $$
+        BEGIN
+            NEW.{shadow} := {cast_fn}(NEW.{column});
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    c.execute(f"DROP TRIGGER IF EXISTS {sync_fn} ON {table}")
+    c.execute(f"""
+        CREATE TRIGGER {sync_fn}
+        BEFORE INSERT OR UPDATE OF {column} ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {sync_fn}()
+    """)
+    c.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+    max_id = c.fetchone()[0]
+    conn.commit()
+
+    # 2. 分批回填
+    last_id = 0
+    while last_id < max_id:
+        upper = last_id + BACKFILL_BATCH_SIZE
+        c.execute(f"""
+            UPDATE {table} SET {shadow} = {cast_fn}({column})
+            WHERE id > %s AND id <= %s AND {shadow} IS NULL AND {column} IS NOT NULL
+        """, (last_id, upper))
+        conn.commit()
+        last_id = upper
+    print(f"   ↳ {table}.{column} 回填完成 (max id {max_id})")
+
+    # 3. 影子欄位的索引 (不鎖寫入)
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        for name, columns, constraint in indexes:
+            tmp_name = f"{name}__new"
+            c.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {tmp_name}")  # 清掉上次失敗留下的 INVALID 索引
+            c.execute(f"""
+                CREATE {"UNIQUE " if constraint else ""}INDEX CONCURRENTLY {tmp_name}
+                ON {table} ({columns.format(col=shadow)})
+            """)
+    finally:
+        conn.autocommit = autocommit
+
+    # 4. 短交易切換
+    c.execute(f"""
+        UPDATE {table} SET {shadow} = {cast_fn}({column})
+        WHERE {shadow} IS NULL AND {column} IS NOT NULL
+    """)
+    c.execute(f"DROP TRIGGER IF EXISTS {sync_fn} ON {table}")
+    c.execute(f"DROP FUNCTION IF EXISTS {sync_fn}()")
+    c.execute(f"ALTER TABLE {table} DROP COLUMN {column}")  # 舊欄位上的索引 / constraint 一併移除
+    c.execute(f"ALTER TABLE {table} RENAME COLUMN {shadow} TO {column}")
+    for name, _, constraint in indexes:
+        c.execute(f"ALTER INDEX {name}__new RENAME TO {name}")
+        if constraint:
+            c.execute(f"ALTER TABLE {table} ADD CONSTRAINT {constraint} UNIQUE USING INDEX {name}")
+    conn.commit()
+    c.close()
+
+
+@migration(4, "temporal columns (TEXT -> TIMESTAMPTZ / TIMESTAMP)", transactional=False)
+def m004_temporal_columns(conn):
+    c = conn.cursor()
+    # 無法解析的舊字串轉成 NULL，而不是讓整個 migration 失敗
+    c.execute("""
+        CREATE OR REPLACE FUNCTION migration_try_timestamptz(t TEXT) RETURNS TIMESTAMPTZ AS $$
+        BEGIN
+            RETURN t::timestamptz;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql STABLE
+    """)
+    c.execute("""
+        CREATE OR REPLACE FUNCTION migration_try_timestamp(t TEXT) RETURNS TIMESTAMP AS $$
+        BEGIN
+            RETURN t::timestamp;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql STABLE
+    """)
+    conn.commit()
+    c.close()
+
+    # 系統產生的時間 (UTC isoformat) -> TIMESTAMPTZ
+    convert_column(conn, "users", "created_at",
+                   "TIMESTAMPTZ", "timestamp with time zone", "migration_try_timestamptz")
+    convert_column(conn, "tracked_flights", "last_checked_at",
+                   "TIMESTAMPTZ", "timestamp with time zone", "migration_try_timestamptz")
+    convert_column(conn, "notifications", "notify_time",
+                   "TIMESTAMPTZ", "timestamp with time zone", "migration_try_timestamptz",
+                   indexes=[("notifications_user_id_notify_time_idx", "user_id, {col}", None)])
+    convert_column(conn, "prices", "checked_time",
+                   "TIMESTAMPTZ", "timestamp with time zone", "migration_try_timestamptz",
+                   indexes=[("prices_flight_id_checked_time_idx", "flight_id, {col}", None)])
+    convert_column(conn, "scheduler_logs", "time",
+                   "TIMESTAMPTZ", "timestamp with time zone", "migration_try_timestamptz",
+                   indexes=[("scheduler_logs_time_idx", "{col}", None)])
+
+    # 航班起降時間是機場當地時間，沒有時區 -> TIMESTAMP
+    convert_column(conn, "tracked_flights", "depart_time",
+                   "TIMESTAMP", "timestamp without time zone", "migration_try_timestamp",
+                   indexes=[
+                       ("tracked_flights_user_flight_depart_key", "user_id, flight_number, {col}",
+                        "tracked_flights_user_flight_depart_key"),
+                       ("tracked_flights_depart_time_idx", "{col}", None),
+                   ])
+    convert_column(conn, "tracked_flights", "arrival_time",
+                   "TIMESTAMP", "timestamp without time zone", "migration_try_timestamp")
+
+    c = conn.cursor()
+    c.execute("DROP FUNCTION IF EXISTS migration_try_timestamptz(TEXT)")
+    c.execute("DROP FUNCTION IF EXISTS migration_try_timestamp(TEXT)")
+    conn.commit()
+    c.close()
+
+
+# ------------------------------------
+# 不鎖寫入地替換索引 (CREATE / DROP INDEX CONCURRENTLY)
+def replace_index(conn, old_name, new_name, table, columns):
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    c = conn.cursor()
+    try:
+        c.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {new_name}")  # 清掉上次失敗留下的 INVALID 索引
+        c.execute(f"CREATE INDEX CONCURRENTLY {new_name} ON {table} ({columns})")
+        c.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {old_name}")
+    finally:
+        c.close()
+        conn.autocommit = autocommit
+
+
+def create_index_concurrently(c, name, table, columns):
+    """CREATE INDEX CONCURRENTLY (須在 autocommit 下呼叫)；已存在且有效時略過，上次失敗留下的 INVALID 索引先刪除"""
+    c.execute("""
+        SELECT i.indisvalid FROM pg_index AS i
+        WHERE i.indexrelid = to_regclass(%s)
+    """, (name,))
+    row = c.fetchone()
+    if row and row[0]:
+        return
+    if row:
+        c.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    c.execute(f"CREATE INDEX CONCURRENTLY {name} ON {table} ({columns})")
+
+
+def create_partitioned_index(conn, name, table, columns):
+    """
+    不鎖寫入地在分區表建立索引 (分區表本身不支援 CREATE INDEX CONCURRENTLY)
+    1. ON ONLY 只在父表建立空的索引 (INVALID)，不掃描分區
+    2. 每個分區各自 CREATE INDEX CONCURRENTLY
+    3. ATTACH 到父表，所有分區都掛上後父表索引自動變為有效；之後新建的分區會自動建立此索引
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    c = conn.cursor()
+    try:
+        c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} ({columns})")
+        c.execute("""
+            SELECT inhrelid::regclass::text FROM pg_inherits
+            WHERE inhparent = to_regclass(%s)
+            ORDER BY 1
+        """, (table,))
+        partitions = [row[0] for row in c.fetchall()]
+        for partition in partitions:
+            partition_index = name.replace(table, partition, 1)
+            create_index_concurrently(c, partition_index, partition, columns)
+            c.execute(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}")  # 已掛上時不做事
+    finally:
+        c.close()
+        conn.autocommit = autocommit
+
+
+@migration(5, "keyset pagination indexes", transactional=False)
+def m005_keyset_indexes(conn):
+    # 分頁以 (時間, id) 排序與比較，id 一併放進索引
+    replace_index(conn, "notifications_user_id_notify_time_idx", "notifications_user_time_id_idx",
+                  "notifications", "user_id, notify_time, id")
+    replace_index(conn, "prices_flight_id_checked_time_idx", "prices_flight_time_id_idx",
+                  "prices", "flight_id, checked_time, id")
+
+
+@migration(6, "hourly / daily price rollups")
+def m006_price_rollups(c):
+    for table in ("prices_hourly", "prices_daily"):
+        c.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                flight_id INTEGER NOT NULL REFERENCES tracked_flights(id) ON DELETE CASCADE,
+                bucket TIMESTAMPTZ NOT NULL,
+                min_price DOUBLE PRECISION,
+                max_price DOUBLE PRECISION,
+                avg_price DOUBLE PRECISION,
+                last_price DOUBLE PRECISION,
+                sample_count INTEGER NOT NULL,
+                PRIMARY KEY (flight_id, bucket)
+            )
+        """)
+        # 保留期限依 bucket 刪除
+        c.execute(f"CREATE INDEX IF NOT EXISTS {table}_bucket_idx ON {table} (bucket)")
+
+    # 各層彙總處理到哪個時間點
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            watermark TIMESTAMPTZ
+        )
+    """)
+
+
+@migration(7, "monthly partitioned prices", transactional=False)
+def m007_partition_prices(conn):
+    # 線上轉換：不整表複製，舊表整個掛成分區表的第一個分區 (涵蓋下個月初之前的資料)
+    # 1. NOT VALID 的 CHECK 先擋住新的無效資料，沒有檢查時間的舊資料分批移到 prices_undated 保留
+    # 2. VALIDATE (不鎖寫入) 證明範圍與 NOT NULL，CREATE INDEX CONCURRENTLY 先建好 (id, checked_time)
+    # 3. 短交易內換主鍵、改名、建立分區表並 ATTACH (有 CHECK 與索引，不會掃描或重建)
+    # 中途失敗可直接重跑
+    c = conn.cursor()
+    c.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('prices')")
+    if c.fetchone()[0] == "p":
+        conn.commit()
+        c.close()
+        return
+    now = datetime.now(timezone.utc)
+    bound = add_months(month_start(now), 1)
+
+    # 1. 擋住新的無效資料 + 搬移沒有檢查時間的資料
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS prices_undated (
+            id INTEGER PRIMARY KEY,
+            flight_id INTEGER REFERENCES tracked_flights(id) ON DELETE CASCADE,
+            checked_time TIMESTAMPTZ,
+            price DOUBLE PRECISION
+        )
+    """)
+    c.execute("ALTER TABLE prices DROP CONSTRAINT IF EXISTS prices_legacy_range")
+    c.execute("""
+        ALTER TABLE prices ADD CONSTRAINT prices_legacy_range
+        CHECK (checked_time IS NOT NULL AND checked_time < %s) NOT VALID
+    """, (bound,))
+    c.execute("SELECT COALESCE(MAX(id), 0) FROM prices")
+    max_id = c.fetchone()[0]
+    conn.commit()
+
+    last_id, moved = 0, 0
+    while last_id < max_id:
+        upper = last_id + BACKFILL_BATCH_SIZE
+        c.execute("""
+            WITH moved AS (
+                DELETE FROM prices
+                WHERE id > %s AND id <= %s AND checked_time IS NULL
+                RETURNING id, flight_id, checked_time, price
+            )
+            INSERT INTO prices_undated (id, flight_id, checked_time, price)
+            SELECT id, flight_id, checked_time, price FROM moved
+            ON CONFLICT (id) DO NOTHING
+        """, (last_id, upper))
+        moved += c.rowcount
+        conn.commit()
+        last_id = upper
+    if moved:
+        print(f"   ↳ {moved} 筆沒有檢查時間的票價已移至 prices_undated")
+
+    # 2. 驗證範圍 + 新主鍵的索引 (都不鎖寫入)
+    c.execute("ALTER TABLE prices VALIDATE CONSTRAINT prices_legacy_range")
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        c.execute("DROP INDEX CONCURRENTLY IF EXISTS prices_legacy_id_time_key")  # 清掉上次失敗留下的 INVALID 索引
+        c.execute("CREATE UNIQUE INDEX CONCURRENTLY prices_legacy_id_time_key ON prices (id, checked_time)")
+    finally:
+        conn.autocommit = autocommit
+
+    # 3. 短交易切換 (已驗證的 CHECK 證明 checked_time 不為 NULL，SET NOT NULL 不必掃描)
+    c.execute("ALTER TABLE prices ALTER COLUMN checked_time SET NOT NULL")
+    c.execute("ALTER TABLE prices DROP CONSTRAINT prices_pkey")
+    c.execute("ALTER TABLE prices ADD CONSTRAINT prices_legacy_pkey PRIMARY KEY USING INDEX prices_legacy_id_time_key")
+    c.execute("ALTER SEQUENCE prices_id_seq OWNED BY NONE")
+    c.execute("ALTER TABLE prices RENAME TO prices_legacy")
+    c.execute("ALTER INDEX IF EXISTS prices_flight_time_id_idx RENAME TO prices_legacy_flight_time_id_idx")
+
+    # 分區表的主鍵必須包含分區欄位
+    c.execute("""
+        CREATE TABLE prices (
+            id INTEGER NOT NULL DEFAULT nextval('prices_id_seq'),
+            flight_id INTEGER REFERENCES tracked_flights(id) ON DELETE CASCADE,
+            checked_time TIMESTAMPTZ NOT NULL,
+            price DOUBLE PRECISION,
+            PRIMARY KEY (id, checked_time)
+        ) PARTITION BY RANGE (checked_time)
+    """)
+    c.execute("ALTER SEQUENCE prices_id_seq OWNED BY prices.id")
+    c.execute("CREATE INDEX prices_flight_time_id_idx ON prices (flight_id, checked_time, id)")
+    c.execute(f"""
+        ALTER TABLE prices ATTACH PARTITION {LEGACY_PARTITION}
+        FOR VALUES FROM (MINVALUE) TO (%s)
+    """, (bound,))
+
+    # 之後每個月一個分區
+    start = bound
+    while start <= add_months(month_start(now), DEFAULT_MONTHS_AHEAD):
+        create_partition(c, start)
+        start = add_months(start, 1)
+    conn.commit()
+    c.close()
+
+
+@migration(8, "cluster job runs")
+def m008_job_runs(c):
+    # 每個排程工作最後一次執行的時段，多個 instance 以此避免重複執行
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS job_runs (
+            job TEXT PRIMARY KEY,
+            slot BIGINT NOT NULL,
+            owner TEXT,
+            started_at TIMESTAMPTZ,
+            finished_at TIMESTAMPTZ,
+            status TEXT
+        )
+    """)
+
+
+@migration(9, "price check job queue")
+def m009_price_check_jobs(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS price_check_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            from_airport TEXT NOT NULL,
+            to_airport TEXT NOT NULL,
+            depart_date DATE NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            locked_by TEXT,
+            locked_at TIMESTAMPTZ,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        )
+    """)
+    # 同一條航線在佇列中 (尚未完成) 只會有一個工作
+    c.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS price_check_jobs_active_route_key
+        ON price_check_jobs (from_airport, to_airport, depart_date)
+        WHERE status IN ('pending', 'running')
+    """)
+    # worker 領取工作
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS price_check_jobs_status_available_idx
+        ON price_check_jobs (status, available_at, id)
+    """)
+
+
+@migration(10, "adaptive polling schedule")
+def m010_next_check_at(c):
+    # 每個航班自己的下次檢查時間；NULL 代表下一輪就檢查
+    c.execute("""
+        ALTER TABLE tracked_flights
+            ADD COLUMN IF NOT EXISTS next_check_at TIMESTAMPTZ,
+            ADD COLUMN IF NOT EXISTS stable_checks INTEGER NOT NULL DEFAULT 0
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS tracked_flights_next_check_at_idx
+        ON tracked_flights (next_check_at)
+    """)
+
+
+@migration(11, "api usage ledger")
+def m011_api_usage(c):
+    # 外部 API 每天、每個 lane (interactive / background) 的呼叫次數
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS api_usage (
+            provider TEXT NOT NULL,
+            day DATE NOT NULL,
+            lane TEXT NOT NULL,
+            calls INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (provider, day, lane)
+        )
+    """)
+
+
+@migration(12, "push outbox")
+def m012_push_outbox(c):
+    # 待發送 / 已發送的 Expo 推播，與 ticket / receipt 紀錄
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS push_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            expo_token TEXT NOT NULL,
+            title TEXT,
+            body TEXT,
+            data JSONB,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            locked_by TEXT,
+            locked_at TIMESTAMPTZ,
+            error TEXT,
+            ticket_id TEXT,
+            sent_at TIMESTAMPTZ,
+            receipt_status TEXT,
+            receipt_error TEXT,
+            receipt_checked_at TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    # dispatcher 領取
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS push_outbox_status_available_idx
+        ON push_outbox (status, available_at, id)
+    """)
+    # 等待查詢 receipt
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS push_outbox_pending_receipt_idx
+        ON push_outbox (sent_at)
+        WHERE status = 'sent' AND receipt_status IS NULL
+    """)
+
+
+@migration(13, "sync change tracking", transactional=False)
+def m013_sync_change_tracking(conn):
+    # version = 最後修改該列的交易 id (txid_current)，/sync 以 snapshot xmin 當游標
+    # 舊資料 version = 0 (首次同步一定會拿到完整資料)
+    # 1. 短交易內加欄位 (只改 metadata)、trigger 與 tombstone 表
+    # 2. 索引以 CREATE INDEX CONCURRENTLY 建立，不鎖寫入
+    # 中途失敗可直接重跑
+    c = conn.cursor()
+    c.execute("""
+        ALTER TABLE tracked_flights
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0
+    """)
+    c.execute("""
+        ALTER TABLE notifications
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0
+    """)
+    # prices 只會新增：以欄位預設值記錄 version，不需要 trigger (先加欄位再設預設值，避免改寫整個表)
+    c.execute("ALTER TABLE prices ADD COLUMN IF NOT EXISTS version BIGINT")
+    c.execute("ALTER TABLE prices ALTER COLUMN version SET DEFAULT txid_current()")
+
+    c.execute("""
+        CREATE OR REPLACE FUNCTION sync_stamp_row() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := txid_current();
+            NEW.updated_at := now();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    c.execute("DROP TRIGGER IF EXISTS tracked_flights_sync_insert ON tracked_flights")
+    c.execute("""
+        CREATE TRIGGER tracked_flights_sync_insert
+        BEFORE INSERT ON tracked_flights
+        FOR EACH ROW EXECUTE FUNCTION sync_stamp_row()
+    """)
+    # 排程每次檢查都會更新 last_checked_at / next_check_at，只有前端看得到的欄位變動才算修改
+    c.execute("DROP TRIGGER IF EXISTS tracked_flights_sync_update ON tracked_flights")
+    c.execute("""
+        CREATE TRIGGER tracked_flights_sync_update
+        BEFORE UPDATE ON tracked_flights
+        FOR EACH ROW
+        WHEN ((OLD.from_airport, OLD.to_airport, OLD.flight_number, OLD.airline,
+               OLD.depart_time, OLD.arrival_time, OLD.price, OLD.min_price)
+              IS DISTINCT FROM
+              (NEW.from_airport, NEW.to_airport, NEW.flight_number, NEW.airline,
+               NEW.depart_time, NEW.arrival_time, NEW.price, NEW.min_price))
+        EXECUTE FUNCTION sync_stamp_row()
+    """)
+    c.execute("DROP TRIGGER IF EXISTS notifications_sync_stamp ON notifications")
+    c.execute("""
+        CREATE TRIGGER notifications_sync_stamp
+        BEFORE INSERT OR UPDATE ON notifications
+        FOR EACH ROW EXECUTE FUNCTION sync_stamp_row()
+    """)
+
+    # 刪除紀錄 (tombstone)：讓前端知道要移除哪些資料
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sync_tombstones (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            version BIGINT NOT NULL DEFAULT txid_current(),
+            deleted_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    c.execute("""
+        CREATE OR REPLACE FUNCTION sync_record_delete() RETURNS trigger AS $$
+        BEGIN
+            IF OLD.user_id IS NOT NULL THEN
+                INSERT INTO sync_tombstones (user_id, entity, entity_id) VALUES (OLD.user_id, TG_TABLE_NAME, OLD.id);
+            END IF;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    for table in ("tracked_flights", "notifications"):
+        c.execute(f"DROP TRIGGER IF EXISTS {table}_sync_delete ON {table}")
+        c.execute(f"""
+            CREATE TRIGGER {table}_sync_delete
+            AFTER DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION sync_record_delete()
+        """)
+
+    conn.commit()
+
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        create_index_concurrently(c, "tracked_flights_user_version_idx", "tracked_flights", "user_id, version")
+        create_index_concurrently(c, "notifications_user_version_idx", "notifications", "user_id, version")
+        create_index_concurrently(c, "sync_tombstones_user_version_idx", "sync_tombstones", "user_id, version")
+        create_index_concurrently(c, "sync_tombstones_deleted_at_idx", "sync_tombstones", "deleted_at")
+    finally:
+        conn.autocommit = autocommit
+        c.close()
+
+    # prices 是分區表 (包含很大的 prices_legacy)：逐個分區建立後掛上父表
+    create_partitioned_index(conn, "prices_flight_version_idx", "prices", "flight_id, version")
+
+
+@migration(14, "tracked flight route index", transactional=False)
+def m014_route_index(conn):
+    # 佇列以 (出發地, 目的地, 出發日期) 對應航線上的航班 (領取、載入、dead 延後)，索引需與查詢的運算式完全相同
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    c = conn.cursor()
+    try:
+        create_index_concurrently(c, "tracked_flights_route_idx", "tracked_flights",
+                                  "upper(trim(from_airport)), upper(trim(to_airport)), (depart_time::date)")
+    finally:
+        c.close()
+        conn.autocommit = autocommit
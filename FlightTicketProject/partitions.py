@@ -0,0 +1,120 @@
+# === prices 每月分區 (PARTITION BY RANGE checked_time) ===
+# 分區名稱固定為 prices_YYYY_MM，範圍為該月 (UTC) [月初, 下個月初)
+# 新分區由排程預先建立；保留期限以整個分區 DROP，不必逐筆刪除
+# 轉換前的舊表整個掛成 prices_legacy 分區 (MINVALUE ~ 轉換當時的下個月初)，月份分區從它的上界開始
+import re
+from datetime import datetime, timezone
+
+PARTITION_PARENT = "prices"
+LEGACY_PARTITION = "prices_legacy"
+DEFAULT_MONTHS_AHEAD = 3  # 預先建立未來幾個月的分區
+_PARTITION_NAME = re.compile(r"^prices_(\d{4})_(\d{2})$")
+
+
+def month_start(dt):
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return datetime(dt.year, dt.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(dt, months):
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(start):
+    return f"{PARTITION_PARENT}_{start.year:04d}_{start.month:02d}"
+
+
+def create_partition(c, start):
+    """建立 start 所在月份的分區，已存在時不做事 (避免不必要地鎖住父表)"""
+    start = month_start(start)
+    name = partition_name(start)
+    c.execute("SELECT to_regclass(%s)", (name,))
+    if c.fetchone()[0] is not None:
+        return False
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARTITION_PARENT}
+        FOR VALUES FROM (%s) TO (%s)
+    """, (start, add_months(start, 1)))
+    return True
+
+
+def legacy_partition_end(c):
+    """prices_legacy 分區的上界 (不存在時回傳 None)"""
+    c.execute("""
+        SELECT (regexp_match(pg_get_expr(relpartbound, oid), 'TO \\(''([^'']+)''\\)'))[1]::timestamptz
+        FROM pg_class
+        WHERE oid = to_regclass(%s) AND relispartition
+    """, (LEGACY_PARTITION,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def ensure_partitions(conn, months_ahead, since=None):
+    """建立 since (預設本月) 到未來 months_ahead 個月的分區 (prices_legacy 已涵蓋的月份略過)，回傳新建的分區名稱"""
+    now = datetime.now(timezone.utc)
+    start = month_start(since or now)
+    end = add_months(month_start(now), months_ahead)
+
+    created = []
+    c = conn.cursor()
+    try:
+        legacy_end = legacy_partition_end(c)
+        if legacy_end is not None and start < legacy_end:
+            start = month_start(legacy_end)
+        while start <= end:
+            if create_partition(c, start):
+                created.append(partition_name(start))
+            start = add_months(start, 1)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
+    return created
+
+
+def list_partitions(c):
+    """回傳 [(分區名稱, 月初)]，依時間排序"""
+    c.execute("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s
+    """, (PARTITION_PARENT,))
+    partitions = []
+    for (name,) in c.fetchall():
+        match = _PARTITION_NAME.match(name)
+        if match:
+            start = datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+            partitions.append((name, start))
+    partitions.sort(key=lambda p: p[1])
+    return partitions
+
+
+def drop_partitions_before(conn, cutoff):
+    """DROP 整個月份都早於 cutoff 的分區，回傳被移除的分區名稱"""
+    dropped = []
+    c = conn.cursor()
+    try:
+        # prices_legacy 涵蓋最早的資料，整個都早於 cutoff 時才移除
+        legacy_end = legacy_partition_end(c)
+        if legacy_end is not None and legacy_end <= cutoff:
+            c.execute(f"DROP TABLE IF EXISTS {LEGACY_PARTITION}")
+            conn.commit()
+            dropped.append(LEGACY_PARTITION)
+        for name, start in list_partitions(c):
+            if add_months(start, 1) > cutoff:
+                break
+            c.execute(f"DROP TABLE IF EXISTS {name}")
+            conn.commit()
+            dropped.append(name)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
+    return dropped
@@ -0,0 +1,36 @@
+# === 每個航班的下次檢查時間 (next_check_at) ===
+# 離出發越近檢查越頻繁；票價連續多次沒變就逐步拉長間隔，一有變動立刻回到基本間隔。
+# next_check_at 為 NULL (剛加入追蹤 / 舊資料) 視為已到期，下一輪排程就會檢查。
+from datetime import datetime, timedelta, timezone
+
+# (距離出發不到幾小時, 基本檢查間隔分鐘)
+DEPARTURE_TIERS = [
+    (72, 30),         # 3 天內
+    (14 * 24, 60),    # 2 週內
+    (60 * 24, 180),   # 2 個月內
+]
+FAR_OUT_INTERVAL_MINUTES = 720  # 更遠的航班
+
+# 每連續 STABLE_STEP 次沒變動，間隔加倍一次，最多 MAX_BACKOFF_DOUBLINGS 次
+STABLE_STEP = 2
+MAX_BACKOFF_DOUBLINGS = 3
+
+
+def base_interval_minutes(depart, now):
+    hours_left = (depart - now).total_seconds() / 3600
+    for limit, minutes in DEPARTURE_TIERS:
+        if hours_left < limit:
+            return minutes
+    return FAR_OUT_INTERVAL_MINUTES
+
+
+def next_check_delay(depart, stable_checks, min_minutes, max_minutes, now=None):
+    """
+    depart: 出發時間 (航班當地時間，無時區；以此估算距離出發的時間已足夠)
+    stable_checks: 票價連續沒有變動的次數
+    """
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    minutes = base_interval_minutes(depart, now)
+    minutes *= 2 ** min(stable_checks // STABLE_STEP, MAX_BACKOFF_DOUBLINGS)
+    minutes = max(min_minutes, min(minutes, max_minutes))
+    return timedelta(minutes=minutes)
@@ -0,0 +1,120 @@
+# === 排程寫入管線 ===
+# 收集一批佇列工作中的 price history、tracked_flights 價格 / 最低價 / 下次檢查時間更新、通知與推播，
+# flush 時用多筆 VALUES 寫入 (每個語句最多 batch_size 列)，與呼叫端在同一個連線上的工作狀態更新一起 commit。
+# 不會依筆數中途 commit：一批工作不是全部寫入就是全部回滾，重試時不會重複寫入票價。
+# SocketIO 事件在同一個交易中以 NOTIFY 發佈 (realtime.PgEmitBus)，commit 後才會送到各 web instance。
+# 票價變動 (price_update) commit 後併入呼叫端的 realtime.PriceUpdateCollector，整輪結束時每個使用者只發一則。
+# 註：已註冊 eventlet wait callback 時 psycopg2 不支援 COPY，因此使用 execute_values。
+from psycopg2.extras import Json, execute_values
+
+
+class PriceCheckWriter:
+
+    def __init__(self, conn, batch_size=500, bus=None, updates=None):
+        self.conn = conn
+        self.bus = bus
+        self.updates = updates
+        self.batch_size = max(1, batch_size)
+        self._prices = []         # (flight_id, checked_time, price)
+        self._checks = {}         # flight_id -> (checked_time, price, next_check_at, stable_checks) (同航班只保留最後一次)
+        self._reschedules = {}    # flight_id -> next_check_at (沒有查到票價，只延後下次檢查)
+        self._notifications = []  # (flight_id, user_id, message, notify_time, price)
+        self._pushes = []         # (user_id, expo_token, title, body, data) -> push_outbox，由 dispatcher 送出
+        self._events = []         # (event, data, room) -> SocketIO 事件匯流排
+        self._updates = {}        # room -> {flight_id: {...}}，commit 後併入 self.updates
+        self.flushed_rows = 0
+        self.flush_count = 0
+
+    def pending(self):
+        return (len(self._prices) + len(self._checks) + len(self._reschedules)
+                + len(self._notifications) + len(self._pushes))
+
+    def add_check(self, flight_id, checked_time, price, next_check_at, stable_checks):
+        """一次檢查：寫入 price history，並更新 tracked_flights 的目前票價、最低價、檢查次數與下次檢查時間"""
+        self._prices.append((flight_id, checked_time, price))
+        self._checks[flight_id] = (checked_time, price, next_check_at, stable_checks)
+
+    def reschedule(self, flight_id, next_check_at):
+        self._reschedules[flight_id] = next_check_at
+
+    def add_notification(self, flight_id, user_id, message, notify_time, price):
+        self._notifications.append((flight_id, user_id, message, notify_time, price))
+
+    def add_push(self, user_id, expo_token, title, body, data=None):
+        self._pushes.append((user_id, expo_token, title, body, Json(data or {})))
+
+    def add_event(self, event, data, room):
+        if self.bus is not None:
+            self._events.append((event, data, room))
+
+    def add_price_update(self, room, flight_id, update):
+        """票價有變動的航班；同航班只保留最後一次"""
+        if self.updates is not None:
+            self._updates.setdefault(room, {})[flight_id] = update
+
+    def flush(self):
+        if not self.pending() and not self._events and not self._updates:
+            return
+
+        c = self.conn.cursor()
+        try:
+            if self._prices:
+                execute_values(c, """
+                    INSERT INTO prices (flight_id, checked_time, price)
+                    VALUES %s
+                """, self._prices, page_size=self.batch_size)
+
+            if self._checks:
+                # min_price 以 LEAST 遞增維護，不必每次對 prices 做 MIN()
+                execute_values(c, """
+                    UPDATE tracked_flights AS tf
+                    SET price = v.price,
+                        min_price = LEAST(COALESCE(tf.min_price, v.price), v.price),
+                        last_checked_at = v.checked_at,
+                        check_count = tf.check_count + 1,
+                        next_check_at = v.next_check_at,
+                        stable_checks = v.stable_checks
+                    FROM (VALUES %s) AS v(id, checked_at, price, next_check_at, stable_checks)
+                    WHERE tf.id = v.id
+                """, [(fid,) + check for fid, check in self._checks.items()],
+                    template="(%s, %s, %s::double precision, %s::timestamptz, %s::integer)",
+                    page_size=self.batch_size)
+
+            if self._reschedules:
+                execute_values(c, """
+                    UPDATE tracked_flights AS tf
+                    SET next_check_at = v.next_check_at
+                    FROM (VALUES %s) AS v(id, next_check_at)
+                    WHERE tf.id = v.id
+                """, list(self._reschedules.items()),
+                    template="(%s, %s::timestamptz)", page_size=self.batch_size)
+
+            if self._notifications:
+                execute_values(c, """
+                    INSERT INTO notifications (flight_id, user_id, message, notify_time, price)
+                    VALUES %s
+                """, self._notifications, page_size=self.batch_size)
+
+            if self._pushes:
+                execute_values(c, """
+                    INSERT INTO push_outbox (user_id, expo_token, title, body, data)
+                    VALUES %s
+                """, self._pushes, page_size=self.batch_size)
+
+            if self._events:
+                self.bus.publish_in(c, self._events)
+
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            c.close()
+
+        self.flushed_rows += self.pending()
+        self.flush_count += 1
+        self._prices, self._checks, self._notifications = [], {}, []
+        self._reschedules, self._pushes, self._events = {}, [], []
+        if self._updates:
+            self.updates.merge(self._updates)
+            self._updates = {}
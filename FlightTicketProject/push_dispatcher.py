@@ -0,0 +1,277 @@
+# === Expo 推播發送佇列 (push_outbox) ===
+# 通知與推播訊息在同一個交易寫入 push_outbox，由 dispatcher 在背景批次送出：
+# - 每次最多 100 則 (Expo 單次請求上限)，共用連線池的 requests.Session，有逾時
+# - 送出失敗 (429 / 5xx / 逾時) 依次數延後重試，超過 max_attempts 標記為 dead
+# - 送出後記錄 ticket id，約 15 分鐘後查詢 receipt；DeviceNotRegistered 時清除使用者的 push token
+# 狀態: pending -> sending -> sent / failed (Expo 拒絕) / dead (重試用完)
+import time
+
+import requests
+from psycopg2.extras import execute_values
+from requests.adapters import HTTPAdapter
+
+from job_queue import retry_delay
+
+EXPO_MAX_BATCH = 100
+EXPO_MAX_RECEIPT_IDS = 1000
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def is_expo_token(token):
+    return bool(token) and token.startswith("ExponentPushToken")
+
+
+class PushDispatcher:
+
+    def __init__(self, pool, base_url="https://exp.host", batch_size=EXPO_MAX_BATCH, timeout=10,
+                 max_attempts=5, retry_base=30, retry_max=1800, access_token=None, worker="dispatcher",
+                 lock_timeout=300):
+        self.pool = pool
+        self.base_url = base_url.rstrip("/")
+        self.batch_size = max(1, min(batch_size, EXPO_MAX_BATCH))
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.worker = worker
+        self.lock_timeout = lock_timeout
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self.session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+            "Content-Type": "application/json",
+        })
+        if access_token:
+            self.session.headers["Authorization"] = f"Bearer {access_token}"
+
+        self._stats = {"batches": 0, "sent": 0, "failed": 0, "retried": 0, "dead": 0,
+                       "receipts_ok": 0, "receipts_error": 0, "tokens_cleared": 0}
+
+    def _post(self, path, payload):
+        res = self.session.post(f"{self.base_url}{path}", json=payload, timeout=self.timeout)
+        if res.status_code in RETRYABLE_STATUS:
+            raise requests.HTTPError(f"HTTP {res.status_code}: {res.text[:200]}")
+        return res.status_code, res.json()
+
+    # ------------------------------------
+    # 送出
+    def _claim(self):
+        with self.pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                UPDATE push_outbox AS p
+                SET status = 'sending', locked_by = %s, locked_at = now(), attempts = p.attempts + 1
+                FROM (
+                    SELECT id FROM push_outbox
+                    WHERE (status = 'pending' AND available_at <= now())
+                       OR (status = 'sending' AND locked_at < now() - %s * interval '1 second')
+                    ORDER BY available_at, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ) AS picked
+                WHERE p.id = picked.id
+                RETURNING p.id, p.user_id, p.expo_token, p.title, p.body, p.data, p.attempts
+            """, (self.worker, self.lock_timeout, self.batch_size))
+            rows = c.fetchall()
+            conn.commit()
+            c.close()
+        return rows
+
+    def send_pending(self):
+        """送出一批待發送的推播，回傳這批的則數 (0 = 沒有待發送)"""
+        rows = self._claim()
+        if not rows:
+            return 0
+
+        messages = [{
+            "to": token,
+            "title": title,
+            "body": body,
+            "sound": "default",
+            "data": data or {},
+        } for _, _, token, title, body, data, _ in rows]
+
+        try:
+            status, result = self._post("/--/api/v2/push/send", messages)
+        except (requests.RequestException, ValueError) as e:
+            print(f"⚠️ 推播發送失敗，稍後重試: {e}")
+            self._retry(rows, str(e))
+            return len(rows)
+
+        tickets = result.get("data") if isinstance(result, dict) else None
+        if status != 200 or not isinstance(tickets, list) or len(tickets) != len(rows):
+            # 整個請求被拒絕 (例如格式錯誤)，重試也不會成功
+            error = str(result.get("errors") if isinstance(result, dict) else result)[:500]
+            print(f"❌ Expo 拒絕推播請求 ({status}): {error}")
+            self._finish(rows, [{"status": "error", "message": error}] * len(rows))
+            return len(rows)
+
+        self._finish(rows, tickets)
+        self._stats["batches"] += 1
+        return len(rows)
+
+    def _retry(self, rows, error):
+        with self.pool.connection() as conn:
+            c = conn.cursor()
+            for row in rows:
+                push_id, attempts = row[0], row[6]
+                if attempts >= self.max_attempts:
+                    c.execute("""
+                        UPDATE push_outbox SET status = 'dead', locked_by = NULL, error = %s
+                        WHERE id = %s
+                    """, (error[:500], push_id))
+                    self._stats["dead"] += 1
+                else:
+                    c.execute("""
+                        UPDATE push_outbox
+                        SET status = 'pending', locked_by = NULL, error = %s,
+                            available_at = now() + %s * interval '1 second'
+                        WHERE id = %s
+                    """, (error[:500], retry_delay(attempts, self.retry_base, self.retry_max), push_id))
+                    self._stats["retried"] += 1
+            conn.commit()
+            c.close()
+
+    def _finish(self, rows, tickets):
+        """依 Expo 回傳的 ticket 更新每則訊息 (ticket 順序與送出順序相同)"""
+        sent, failed, unregistered = [], [], []
+        for row, ticket in zip(rows, tickets):
+            if ticket.get("status") == "ok":
+                sent.append((row[0], ticket.get("id")))
+            else:
+                details = ticket.get("details") or {}
+                failed.append((row[0], details.get("error") or ticket.get("message") or "error"))
+                if details.get("error") == "DeviceNotRegistered":
+                    unregistered.append((row[1], row[2]))
+
+        with self.pool.connection() as conn:
+            c = conn.cursor()
+            if sent:
+                execute_values(c, """
+                    UPDATE push_outbox AS p
+                    SET status = 'sent', locked_by = NULL, sent_at = now(), ticket_id = v.ticket_id, error = NULL
+                    FROM (VALUES %s) AS v(id, ticket_id)
+                    WHERE p.id = v.id
+                """, sent, template="(%s::bigint, %s)")
+            if failed:
+                execute_values(c, """
+                    UPDATE push_outbox AS p
+                    SET status = 'failed', locked_by = NULL, sent_at = now(), error = v.error
+                    FROM (VALUES %s) AS v(id, error)
+                    WHERE p.id = v.id
+                """, failed, template="(%s::bigint, %s)")
+            self._clear_tokens(c, unregistered)
+            conn.commit()
+            c.close()
+
+        self._stats["sent"] += len(sent)
+        self._stats["failed"] += len(failed)
+
+    def _clear_tokens(self, c, unregistered):
+        """裝置已解除註冊：清除 users 上仍是同一個 token 的紀錄"""
+        for user_id, token in unregistered:
+            c.execute("""
+                UPDATE users SET expo_push_token = NULL
+                WHERE id = %s AND expo_push_token = %s
+            """, (user_id, token))
+            self._stats["tokens_cleared"] += c.rowcount
+
+    # ------------------------------------
+    # 查詢 receipt
+    def check_receipts(self, delay_seconds=900, keep_days=7):
+        """查詢送出超過 delay_seconds 秒、還沒有 receipt 的訊息，回傳查詢的則數"""
+        with self.pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT id, user_id, expo_token, ticket_id FROM push_outbox
+                WHERE status = 'sent' AND receipt_status IS NULL AND ticket_id IS NOT NULL
+                  AND sent_at < now() - %s * interval '1 second'
+                ORDER BY sent_at
+                LIMIT %s
+            """, (delay_seconds, EXPO_MAX_RECEIPT_IDS))
+            rows = c.fetchall()
+
+            # 舊紀錄只保留一段時間
+            c.execute("""
+                DELETE FROM push_outbox
+                WHERE status IN ('sent', 'failed') AND sent_at < now() - %s * interval '1 day'
+            """, (keep_days,))
+            conn.commit()
+            c.close()
+        if not rows:
+            return 0
+
+        try:
+            status, result = self._post("/--/api/v2/push/getReceipts", {"ids": [r[3] for r in rows]})
+        except (requests.RequestException, ValueError) as e:
+            print(f"⚠️ 查詢推播 receipt 失敗: {e}")
+            return 0
+        receipts = result.get("data") if status == 200 and isinstance(result, dict) else None
+        if not isinstance(receipts, dict):
+            print(f"⚠️ 查詢推播 receipt 失敗 ({status})")
+            return 0
+
+        updates, unregistered = [], []
+        for push_id, user_id, token, ticket_id in rows:
+            receipt = receipts.get(ticket_id)
+            if receipt is None:
+                # Expo 尚未產生 (或已超過保存期限)；超過一天就不再查
+                updates.append((push_id, None, None))
+                continue
+            if receipt.get("status") == "ok":
+                updates.append((push_id, "ok", None))
+                self._stats["receipts_ok"] += 1
+            else:
+                details = receipt.get("details") or {}
+                updates.append((push_id, "error", details.get("error") or receipt.get("message")))
+                self._stats["receipts_error"] += 1
+                if details.get("error") == "DeviceNotRegistered":
+                    unregistered.append((user_id, token))
+
+        with self.pool.connection() as conn:
+            c = conn.cursor()
+            execute_values(c, """
+                UPDATE push_outbox AS p
+                SET receipt_status = CASE
+                        WHEN v.receipt_status IS NULL AND p.sent_at < now() - interval '1 day' THEN 'unknown'
+                        ELSE v.receipt_status
+                    END,
+                    receipt_error = v.receipt_error,
+                    receipt_checked_at = now()
+                FROM (VALUES %s) AS v(id, receipt_status, receipt_error)
+                WHERE p.id = v.id
+            """, updates, template="(%s::bigint, %s::text, %s::text)")
+            self._clear_tokens(c, unregistered)
+            conn.commit()
+            c.close()
+        return len(rows)
+
+    # ------------------------------------
+    def run_forever(self, interval=2, receipt_interval=300, receipt_delay=900):
+        """背景迴圈：有待發送的推播就連續送，沒有就等 interval 秒；每 receipt_interval 秒查一次 receipt"""
+        print(f"📨 推播 dispatcher 啟動 ({self.base_url})")
+        last_receipts = 0.0
+        while True:
+            try:
+                sent = self.send_pending()
+                if time.monotonic() - last_receipts >= receipt_interval:
+                    last_receipts = time.monotonic()
+                    self.check_receipts(receipt_delay)
+                if sent:
+                    continue
+            except Exception as e:
+                print(f"⚠️ 推播 dispatcher 發生錯誤: {e}")
+            time.sleep(interval)  # eventlet monkey_patch 後只會讓出目前的 green thread
+
+    def stats(self):
+        data = dict(self._stats)
+        with self.pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT status, COUNT(*) FROM push_outbox GROUP BY status")
+            data["outbox"] = {status: count for status, count in c.fetchall()}
+            conn.commit()
+            c.close()
+        return data
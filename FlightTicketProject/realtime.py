@@ -0,0 +1,201 @@
+# === SocketIO 即時通知 ===
+# 連線時以 JWT 驗證，每個使用者加入自己的 room (user_<id>)，通知只送到該 room
+import json
+import select
+import threading
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+
+def user_room(user_id):
+    return f"user_{user_id}"
+
+
+class ConnectionRegistry:
+    """記錄目前的連線 (sid -> user_id) 與每個使用者的連線數，供 /debug/sockets 估算伺服器負載"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}   # sid -> user_id
+        self._per_user = {}   # user_id -> 連線數
+        self._stats = {"connects": 0, "disconnects": 0, "rejected": 0, "peak_connections": 0}
+
+    def add(self, sid, user_id):
+        with self._lock:
+            self._sessions[sid] = user_id
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+            self._stats["connects"] += 1
+            self._stats["peak_connections"] = max(self._stats["peak_connections"], len(self._sessions))
+
+    def remove(self, sid):
+        with self._lock:
+            user_id = self._sessions.pop(sid, None)
+            if user_id is None:
+                return None
+            self._stats["disconnects"] += 1
+            remaining = self._per_user.get(user_id, 1) - 1
+            if remaining > 0:
+                self._per_user[user_id] = remaining
+            else:
+                self._per_user.pop(user_id, None)
+            return user_id
+
+    def reject(self):
+        with self._lock:
+            self._stats["rejected"] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data.update({
+                "connections": len(self._sessions),
+                "rooms": len(self._per_user),
+                "max_connections_per_user": max(self._per_user.values(), default=0),
+            })
+        return data
+
+
+class PriceUpdateCollector:
+    """
+    一輪排程 (把佇列消化完為止) 中票價有變動的航班，依使用者 room 合併
+    結束時每個使用者發一則 price_update (航班太多時依 MAX_FLIGHTS 拆開，NOTIFY payload 上限 8000 bytes)
+    佇列一直消化不完時，呼叫端以 due() 判斷是否已累積太久、先發佈一次
+    """
+    MAX_FLIGHTS = 100
+
+    def __init__(self):
+        self._rooms = {}  # room -> {flight_id: {...}}
+        self._pending_since = None  # 最早一筆尚未發佈的變動合併進來的時間 (monotonic)
+
+    def merge(self, updates):
+        if updates and self._pending_since is None:
+            self._pending_since = time.monotonic()
+        for room, flights in updates.items():
+            self._rooms.setdefault(room, {}).update(flights)
+
+    def due(self, max_delay):
+        """尚未發佈的變動已等待超過 max_delay 秒"""
+        return self._pending_since is not None and time.monotonic() - self._pending_since >= max_delay
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def events(self, checked_at):
+        events = []
+        for room, flights in self._rooms.items():
+            items = [{"id": fid, **update} for fid, update in flights.items()]
+            for i in range(0, len(items), self.MAX_FLIGHTS):
+                events.append(("price_update", {
+                    "checked_at": checked_at,
+                    "flights": items[i:i + self.MAX_FLIGHTS]
+                }, room))
+        return events
+
+    def publish(self, bus):
+        """發佈並清空，回傳發佈的事件數"""
+        if not self._rooms:
+            return 0
+        events = self.events(datetime.now(timezone.utc).isoformat())
+        self._rooms = {}
+        self._pending_since = None
+        bus.publish_events(events)
+        return len(events)
+
+
+class PgEmitBus:
+    """
+    跨 process 的 SocketIO emit：事件以 PostgreSQL NOTIFY 發佈，每個 web process 以 LISTEN 接收後在本機 emit
+    worker / 其他 instance 產生的通知也能送到連在任何一台 web instance 上的使用者
+    publish_in 在呼叫端的交易中 NOTIFY，commit 後才會送出 (rollback 則不會送出)
+    """
+    MAX_PAYLOAD = 7900  # NOTIFY payload 上限 8000 bytes
+
+    def __init__(self, pool, dsn, channel="socketio_events"):
+        if not channel.isidentifier():
+            raise ValueError(f"無效的 NOTIFY channel: {channel}")
+        self.pool = pool
+        self.dsn = dsn
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._stats = {"published": 0, "dropped": 0, "delivered": 0, "reconnects": 0}
+        self._listening = False
+
+    def _payloads(self, events):
+        payloads = []
+        for event, data, room in events:
+            payload = json.dumps({"event": event, "data": data, "room": room}, ensure_ascii=False, default=str)
+            if len(payload.encode("utf-8")) > self.MAX_PAYLOAD:
+                print(f"⚠️ SocketIO 事件 {event} 過大，未發佈")
+                with self._lock:
+                    self._stats["dropped"] += 1
+                continue
+            payloads.append((payload,))
+        return payloads
+
+    def publish_in(self, c, events):
+        """events: [(event, data, room)]，在 cursor 所在的交易中 NOTIFY (不 commit)"""
+        payloads = self._payloads(events)
+        if not payloads:
+            return
+        execute_values(c, f"""
+            SELECT pg_notify('{self.channel}', v.payload) FROM (VALUES %s) AS v(payload)
+        """, payloads)
+        with self._lock:
+            self._stats["published"] += len(payloads)
+
+    def publish_events(self, events):
+        """events: [(event, data, room)]，自行借連線發佈"""
+        with self.pool.connection() as conn:
+            c = conn.cursor()
+            self.publish_in(c, events)
+            conn.commit()
+            c.close()
+
+    def listen_forever(self, deliver, reconnect_delay=5):
+        """持續 LISTEN，收到事件就呼叫 deliver(event, data, room)；連線中斷時自動重連"""
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                c = conn.cursor()
+                c.execute(f"LISTEN {self.channel}")
+                self._listening = True
+                print(f"📡 SocketIO 事件匯流排開始監聽 ({self.channel})")
+
+                while True:
+                    # monkey_patch 後 select 只會讓出目前的 green thread
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            message = json.loads(notify.payload)
+                            deliver(message["event"], message["data"], message.get("room"))
+                            with self._lock:
+                                self._stats["delivered"] += 1
+                        except Exception as e:
+                            print(f"⚠️ SocketIO 事件處理失敗: {e}")
+            except Exception as e:
+                print(f"⚠️ SocketIO 事件匯流排中斷，{reconnect_delay} 秒後重連: {e}")
+            finally:
+                self._listening = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            with self._lock:
+                self._stats["reconnects"] += 1
+            time.sleep(reconnect_delay)
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+        data["listening"] = self._listening
+        data["channel"] = self.channel
+        return data
@@ -0,0 +1,218 @@
+# === 票價歷史彙總 (每小時 / 每日) 與保留期限 ===
+# prices (原始資料) -> prices_hourly -> prices_daily
+# 每次只處理上次水位 (watermark) 之後、已經結束的時段，重跑也不會重複計算
+# 水位以 checked_time 記錄，較晚 commit 的資料 (檢查時間在水位之前) 靠每次重新彙總水位前的 ROLLUP_LOOKBACK 補上；
+# 彙總是整個時段重新計算後覆蓋，重算不會重複累加
+from datetime import datetime, timedelta, timezone
+
+from partitions import drop_partitions_before
+
+RETENTION_DELETE_BATCH = 10000
+ROLLUP_LOOKBACK = timedelta(hours=1)  # 每小時彙總重算水位前多久 (每日彙總重算水位前一天)
+
+# 各粒度的時段長度 (auto 挑選粒度時使用)
+GRANULARITY_SECONDS = {
+    "raw": 0,
+    "hourly": 3600,
+    "daily": 86400,
+}
+
+
+def get_watermark(c, name):
+    c.execute("SELECT watermark FROM rollup_state WHERE name = %s", (name,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def _set_watermark(c, name, watermark):
+    c.execute("""
+        INSERT INTO rollup_state (name, watermark) VALUES (%s, %s)
+        ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark
+    """, (name, watermark))
+
+
+def rollup_hourly(conn):
+    """把 watermark 之後 (含之前 ROLLUP_LOOKBACK)、已結束的每個小時彙總進 prices_hourly"""
+    c = conn.cursor()
+    watermark = get_watermark(c, "hourly")
+    c.execute("SELECT date_trunc('hour', now())")
+    upto = c.fetchone()[0]
+    if watermark is not None and watermark >= upto:
+        conn.commit()
+        c.close()
+        return 0
+
+    c.execute("""
+        INSERT INTO prices_hourly (flight_id, bucket, min_price, max_price, avg_price, last_price, sample_count)
+        SELECT flight_id,
+               date_trunc('hour', checked_time),
+               MIN(price), MAX(price), AVG(price),
+               (array_agg(price ORDER BY checked_time DESC, id DESC))[1],
+               COUNT(*)
+        FROM prices
+        WHERE checked_time >= COALESCE(%s::timestamptz - %s, '-infinity'::timestamptz) AND checked_time < %s
+        GROUP BY 1, 2
+        ON CONFLICT (flight_id, bucket) DO UPDATE SET
+            min_price = EXCLUDED.min_price,
+            max_price = EXCLUDED.max_price,
+            avg_price = EXCLUDED.avg_price,
+            last_price = EXCLUDED.last_price,
+            sample_count = EXCLUDED.sample_count
+    """, (watermark, ROLLUP_LOOKBACK, upto))
+    count = c.rowcount
+    _set_watermark(c, "hourly", upto)
+    conn.commit()
+    c.close()
+    return count
+
+
+def rollup_daily(conn):
+    """把 watermark 之後 (含前一天)、已結束的每一天 (UTC) 由 prices_hourly 彙總進 prices_daily"""
+    c = conn.cursor()
+    watermark = get_watermark(c, "daily")
+    hourly_watermark = get_watermark(c, "hourly")
+    if hourly_watermark is None:
+        conn.commit()
+        c.close()
+        return 0
+
+    # 只處理每小時彙總已經完整涵蓋的日子
+    c.execute("SELECT date_trunc('day', %s::timestamptz, 'UTC')", (hourly_watermark,))
+    upto = c.fetchone()[0]
+    if watermark is not None and watermark >= upto:
+        conn.commit()
+        c.close()
+        return 0
+
+    c.execute("""
+        INSERT INTO prices_daily (flight_id, bucket, min_price, max_price, avg_price, last_price, sample_count)
+        SELECT flight_id,
+               date_trunc('day', bucket, 'UTC'),
+               MIN(min_price), MAX(max_price),
+               SUM(avg_price * sample_count) / SUM(sample_count),
+               (array_agg(last_price ORDER BY bucket DESC))[1],
+               SUM(sample_count)
+        FROM prices_hourly
+        WHERE bucket >= COALESCE(%s::timestamptz - interval '1 day', '-infinity'::timestamptz) AND bucket < %s
+        GROUP BY 1, 2
+        ON CONFLICT (flight_id, bucket) DO UPDATE SET
+            min_price = EXCLUDED.min_price,
+            max_price = EXCLUDED.max_price,
+            avg_price = EXCLUDED.avg_price,
+            last_price = EXCLUDED.last_price,
+            sample_count = EXCLUDED.sample_count
+    """, (watermark, upto))
+    count = c.rowcount
+    _set_watermark(c, "daily", upto)
+    conn.commit()
+    c.close()
+    return count
+
+
+# key_cols: 用來定位資料列的主鍵欄位 (例如 "flight_id, bucket")
+def _delete_in_batches(conn, table, key_cols, time_col, cutoff):
+    c = conn.cursor()
+    total = 0
+    while True:
+        c.execute(f"""
+            DELETE FROM {table}
+            WHERE ({key_cols}) IN (
+                SELECT {key_cols} FROM {table} WHERE {time_col} < %s LIMIT %s
+            )
+        """, (cutoff, RETENTION_DELETE_BATCH))
+        deleted = c.rowcount
+        conn.commit()
+        total += deleted
+        if deleted < RETENTION_DELETE_BATCH:
+            break
+    c.close()
+    return total
+
+
+def apply_retention(conn, raw_days, hourly_days):
+    """
+    刪除超過保留天數的原始 / 每小時資料 (0 = 永久保留)
+    只會刪除已經彙總到下一層的資料；原始資料以整個月份分區 DROP
+    """
+    c = conn.cursor()
+    hourly_watermark = get_watermark(c, "hourly")
+    daily_watermark = get_watermark(c, "daily")
+    conn.commit()
+    c.close()
+
+    now = datetime.now(timezone.utc)
+    deleted = {"raw_partitions": [], "hourly": 0}
+    # 保留重新彙總會讀到的範圍
+    if raw_days and hourly_watermark:
+        cutoff = min(now - timedelta(days=raw_days), hourly_watermark - ROLLUP_LOOKBACK)
+        deleted["raw_partitions"] = drop_partitions_before(conn, cutoff)
+    if hourly_days and daily_watermark:
+        cutoff = min(now - timedelta(days=hourly_days), daily_watermark - timedelta(days=1))
+        deleted["hourly"] = _delete_in_batches(conn, "prices_hourly", "flight_id, bucket", "bucket", cutoff)
+    return deleted
+
+
+def choose_granularity(c, flight_id, range_from, range_to, points, raw_days):
+    """
+    挑選能提供至少 points 個時段的最粗粒度
+    查詢範圍早於原始資料保留期限時，至少使用每小時彙總
+    """
+    if range_from is None:
+        c.execute("SELECT MIN(bucket) FROM prices_daily WHERE flight_id = %s", (flight_id,))
+        first = c.fetchone()[0]
+        if first is None:
+            c.execute("SELECT MIN(checked_time) FROM prices WHERE flight_id = %s", (flight_id,))
+            first = c.fetchone()[0]
+        range_from = first
+    if range_from is None:
+        return "raw"
+
+    now = datetime.now(timezone.utc)
+    span = ((range_to or now) - range_from).total_seconds()
+    for granularity in ("daily", "hourly"):
+        if span / GRANULARITY_SECONDS[granularity] >= points:
+            return granularity
+
+    if raw_days and range_from < now - timedelta(days=raw_days):
+        return "hourly"
+    return "raw"
+
+
+def load_price_series(c, flight_id, range_from, range_to, granularity, value="last"):
+    """
+    依粒度讀取 [(time, price)]，彙總尚未涵蓋的最近時段以較細的資料補上
+    value: 彙總資料取哪個值 (min / max / avg / last)
+    """
+    if value not in ("min", "max", "avg", "last"):
+        raise ValueError(f"未知的彙總值: {value}")
+    value_col = f"{value}_price"
+    lo = range_from or datetime.min.replace(tzinfo=timezone.utc)
+    hi = range_to or datetime.max.replace(tzinfo=timezone.utc)
+
+    if granularity == "raw":
+        c.execute("""
+            SELECT checked_time, price FROM prices
+            WHERE flight_id = %s AND checked_time >= %s AND checked_time < %s
+            ORDER BY checked_time, id
+        """, (flight_id, lo, hi))
+        return c.fetchall()
+
+    hourly_wm = get_watermark(c, "hourly") or datetime.min.replace(tzinfo=timezone.utc)
+    daily_wm = get_watermark(c, "daily") or datetime.min.replace(tzinfo=timezone.utc)
+    if granularity == "hourly":
+        daily_wm = datetime.min.replace(tzinfo=timezone.utc)
+
+    c.execute(f"""
+        SELECT bucket, {value_col} FROM prices_daily
+        WHERE flight_id = %(id)s AND bucket >= %(lo)s AND bucket < %(hi)s AND bucket < %(daily_wm)s
+        UNION ALL
+        SELECT bucket, {value_col} FROM prices_hourly
+        WHERE flight_id = %(id)s AND bucket >= %(lo)s AND bucket < %(hi)s
+          AND bucket >= %(daily_wm)s AND bucket < %(hourly_wm)s
+        UNION ALL
+        SELECT checked_time, price FROM prices
+        WHERE flight_id = %(id)s AND checked_time >= %(lo)s AND checked_time < %(hi)s
+          AND checked_time >= %(hourly_wm)s
+        ORDER BY 1
+    """, {"id": flight_id, "lo": lo, "hi": hi, "daily_wm": daily_wm, "hourly_wm": hourly_wm})
+    return c.fetchall()
@@ -0,0 +1,166 @@
+# === 航班查詢結果快取 (TTL + LRU + stale-while-revalidate) ===
+import threading
+import time
+from collections import OrderedDict
+
+
+def _spawn_thread(fn, *args):
+    threading.Thread(target=fn, args=args, daemon=True).start()
+
+
+class SearchCache:
+    """
+    - maxsize: 最多保留幾筆，超過時淘汰最久沒用到的 (LRU)
+    - ttl: 幾秒內的資料視為新鮮，直接回傳
+    - stale_ttl: 過了 ttl 之後再多幾秒內仍先回傳舊資料，同時在背景重新查詢
+    - spawn: 背景更新用的啟動函式 (預設開 thread，eventlet 下可傳 eventlet.spawn_n)
+    """
+
+    def __init__(self, maxsize=256, ttl=300, stale_ttl=600, spawn=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._spawn = spawn or _spawn_thread
+
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (value, 寫入時間)
+        self._refreshing = set()
+        self._stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "refreshes": 0,
+            "refresh_errors": 0,
+        }
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def get_or_load(self, key, loader, max_age=None):
+        """
+        先查快取，沒有才呼叫 loader() 並寫入快取 (loader 回傳 None 不快取)
+        指定 max_age 時只接受比 max_age 更新的資料，且不回傳過期資料
+        """
+        refresh = False
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                age = time.monotonic() - stored_at
+                fresh_limit = self.ttl if max_age is None else min(max_age, self.ttl)
+
+                if age <= fresh_limit:
+                    self._data.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value
+
+                if max_age is None and age <= self.ttl + self.stale_ttl:
+                    self._data.move_to_end(key)
+                    self._stats["stale_hits"] += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        refresh = True
+                elif age > self.ttl + self.stale_ttl:
+                    del self._data[key]
+
+            if not refresh:
+                self._stats["misses"] += 1
+
+        if refresh:
+            # 先回傳舊資料，背景重新查詢
+            self._spawn(self._refresh, key, loader)
+            return value
+
+        value = loader()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def _refresh(self, key, loader):
+        try:
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+            with self._lock:
+                self._stats["refreshes"] += 1
+        except Exception as e:
+            with self._lock:
+                self._stats["refresh_errors"] += 1
+            print(f"⚠️ 快取背景更新失敗 {key}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data.update({
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+            })
+        lookups = data["hits"] + data["stale_hits"] + data["misses"]
+        data["hit_rate"] = round((data["hits"] + data["stale_hits"]) / lookups, 3) if lookups else 0.0
+        return data
+
+
+class SingleFlight:
+    """
+    同一個 key 同時只會有一個呼叫真正執行
+    其他同時進來的呼叫者等待並共用同一份結果 (或同一個例外)
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {"executed": 0, "coalesced": 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._stats["coalesced"] += 1
+                leader = False
+            else:
+                call = self._Call()
+                self._calls[key] = call
+                self._stats["executed"] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["in_flight"] = len(self._calls)
+        return data
@@ -0,0 +1,125 @@
+# === 增量同步 (/sync) ===
+# tracked_flights / notifications / prices 每列記錄最後修改它的交易 id (version，由 trigger / 欄位預設值填入)，
+# 刪除時寫入 sync_tombstones。游標是讀取當下 snapshot 的 xmin：比它小的交易都已結束，
+# 因此 version 在 [上次游標, 這次游標) 之間的變動剛好傳一次，不會漏掉還沒 commit 的交易。
+# 讀取必須在 REPEATABLE READ 交易中進行，所有查詢與游標才會使用同一個 snapshot。
+# 排程的記錄欄位 (last_checked_at / check_count / next_check_at) 變動不算修改，因此不在同步資料中。
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+
+TOMBSTONE_ENTITIES = {"tracked_flights": "flights", "notifications": "notifications"}
+
+
+def encode_sync_cursor(version, issued_at):
+    raw = json.dumps([version, issued_at.isoformat()]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_sync_cursor(cursor):
+    """回傳 (version, issued_at)；格式錯誤時丟出 ValueError"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        version, issued_at = json.loads(base64.urlsafe_b64decode(padded))
+        return int(version), datetime.fromisoformat(issued_at)
+    except Exception:
+        raise ValueError("since 格式錯誤")
+
+
+def begin_snapshot(c):
+    """開始 REPEATABLE READ 交易並回傳 (游標 version, 現在時間)；必須是交易中的第一個查詢"""
+    c.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+    c.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()), now()")
+    return c.fetchone()
+
+
+def cursor_expired(issued_at, tombstone_days, now=None):
+    """游標比 tombstone 保留期限還舊時，刪除紀錄可能已清掉，只能重新完整同步"""
+    now = now or datetime.now(timezone.utc)
+    return issued_at < now - timedelta(days=tombstone_days)
+
+
+def load_changes(c, user_id, since, upto, limit):
+    """
+    version 在 [since, upto) 之間的新增 / 修改 / 刪除
+    任何一類超過 limit 筆時回傳 None (變動太多，改為完整同步)
+    """
+    c.execute("""
+        SELECT id, from_airport, to_airport, flight_number, airline, depart_time, arrival_time, price,
+               min_price, updated_at
+        FROM tracked_flights
+        WHERE user_id = %s AND version >= %s AND version < %s
+        ORDER BY id
+        LIMIT %s
+    """, (user_id, since, upto, limit + 1))
+    flights = c.fetchall()
+
+    c.execute("""
+        SELECT id, flight_id, message, notify_time, price
+        FROM notifications
+        WHERE user_id = %s AND version >= %s AND version < %s
+        ORDER BY notify_time, id
+        LIMIT %s
+    """, (user_id, since, upto, limit + 1))
+    notifications = c.fetchall()
+
+    # 航班被刪除時它的票價一起刪除，前端收到航班的 tombstone 就移除該航班的票價
+    c.execute("""
+        SELECT p.id, p.flight_id, p.checked_time, p.price
+        FROM tracked_flights AS tf
+        JOIN prices AS p ON p.flight_id = tf.id
+        WHERE tf.user_id = %s AND p.version >= %s AND p.version < %s
+        ORDER BY p.checked_time, p.id
+        LIMIT %s
+    """, (user_id, since, upto, limit + 1))
+    prices = c.fetchall()
+
+    c.execute("""
+        SELECT entity, entity_id FROM sync_tombstones
+        WHERE user_id = %s AND version >= %s AND version < %s
+        ORDER BY id
+        LIMIT %s
+    """, (user_id, since, upto, limit + 1))
+    tombstones = c.fetchall()
+
+    if max(len(flights), len(notifications), len(prices), len(tombstones)) > limit:
+        return None
+
+    deleted = {name: [] for name in TOMBSTONE_ENTITIES.values()}
+    for entity, entity_id in tombstones:
+        deleted[TOMBSTONE_ENTITIES[entity]].append(entity_id)
+    return flights, notifications, prices, deleted
+
+
+def load_snapshot(c, user_id):
+    """完整同步：目前所有的航班與通知 (票價歷史太大，由前端需要時再查 /prices)"""
+    c.execute("""
+        SELECT id, from_airport, to_airport, flight_number, airline, depart_time, arrival_time, price,
+               min_price, updated_at
+        FROM tracked_flights
+        WHERE user_id = %s
+        ORDER BY id
+    """, (user_id,))
+    flights = c.fetchall()
+
+    c.execute("""
+        SELECT id, flight_id, message, notify_time, price
+        FROM notifications
+        WHERE user_id = %s
+        ORDER BY notify_time, id
+    """, (user_id,))
+    notifications = c.fetchall()
+    return flights, notifications
+
+
+def purge_tombstones(conn, keep_days):
+    """刪除超過保留期限的 tombstone，回傳刪除筆數"""
+    c = conn.cursor()
+    c.execute("""
+        DELETE FROM sync_tombstones
+        WHERE deleted_at < now() - %s * interval '1 day'
+    """, (keep_days,))
+    deleted = c.rowcount
+    conn.commit()
+    c.close()
+    return deleted
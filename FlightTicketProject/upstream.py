@@ -0,0 +1,383 @@
+# === 外部 API (RapidAPI) 呼叫輔助工具 ===
+# 所有 RapidAPI 請求都經過 call_with_retry + ApiBudget.acquire(lane)：
+# 1. circuit breaker：上游持續失敗時直接拒絕，不再等 timeout
+# 2. 額度檢查 (每日 / 每月用量記在資料庫，多個 process 共用)
+# 3. token bucket 限速，使用者查詢 (interactive) 優先於排程 (background)
+# 4. 記帳；429 / 5xx / 逾時以指數退避 + 隨機抖動重試
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import requests
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class UpstreamError(Exception):
+    def __init__(self, status_code, text, retry_after=None):
+        super().__init__(f"API 錯誤: {status_code}")
+        self.status_code = status_code
+        self.text = text
+        self.retry_after = retry_after
+
+
+class UpstreamUnavailable(Exception):
+    """目前不能呼叫上游 (額度不足 / circuit 開啟)；retry_after: 建議幾秒後再試 (None = 不確定)"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QuotaExceeded(UpstreamUnavailable):
+    """額度不足：interactive = 已用完；background = 剩餘額度保留給使用者查詢，排程應延後"""
+
+    def __init__(self, lane, message):
+        super().__init__(message)
+        self.lane = lane
+
+
+class CircuitOpen(UpstreamUnavailable):
+    pass
+
+
+class TokenBucket:
+    """
+    每秒補充 rate 個 token，最多累積 burst 個
+    有 interactive 請求在等待時，background 請求讓出 token
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1.0, float(burst))
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._interactive_waiting = 0
+        self._stats = {"acquired": {INTERACTIVE: 0, BACKGROUND: 0}, "waited_seconds": 0.0}
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, lane=BACKGROUND):
+        """取得一個 token，回傳等待秒數"""
+        if not self.rate or self.rate <= 0:
+            return 0.0
+
+        started = time.monotonic()
+        interactive = lane == INTERACTIVE
+        if interactive:
+            with self._lock:
+                self._interactive_waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._tokens >= 1 and (interactive or not self._interactive_waiting):
+                        self._tokens -= 1
+                        waited = now - started
+                        self._stats["acquired"][lane] += 1
+                        self._stats["waited_seconds"] += waited
+                        return waited
+                    delay = (1 - self._tokens) / self.rate if self._tokens < 1 else 1.0 / self.rate
+                time.sleep(max(delay, 0.01))  # eventlet monkey_patch 後只會讓出目前的 green thread
+        finally:
+            if interactive:
+                with self._lock:
+                    self._interactive_waiting -= 1
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "tokens": round(self._tokens, 2),
+                "interactive_waiting": self._interactive_waiting,
+                "acquired": dict(self._stats["acquired"]),
+                "waited_seconds": round(self._stats["waited_seconds"], 3),
+            }
+
+
+class QuotaLedger:
+    """
+    api_usage 資料表記錄每天、每個 lane 的呼叫次數
+    今日 / 本月用量在記憶體快取 refresh_interval 秒，其他 process 的用量在下次更新時反映
+    同時只有一個 thread 重新讀取，其他 thread 沿用快取；讀取失敗 (例如連線池逾時) 時也沿用上次的數字
+    """
+
+    def __init__(self, pool, provider, refresh_interval=30):
+        self.pool = pool
+        self.provider = provider
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._day = None
+        self._today = 0
+        self._month = 0
+        self._loaded_at = 0.0
+        self._refreshing = False
+
+    def _refresh(self):
+        today = datetime.now(timezone.utc).date()
+        with self.pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT COALESCE(SUM(calls) FILTER (WHERE day = %s), 0), COALESCE(SUM(calls), 0)
+                FROM api_usage
+                WHERE provider = %s AND day >= date_trunc('month', %s::date)
+            """, (today, self.provider, today))
+            used_today, used_month = c.fetchone()
+            conn.commit()
+            c.close()
+        with self._lock:
+            self._day, self._today, self._month = today, used_today, used_month
+            self._loaded_at = time.monotonic()
+
+    def usage(self):
+        """回傳 (今日用量, 本月用量)"""
+        with self._lock:
+            same_day = self._day == datetime.now(timezone.utc).date()
+            fresh = same_day and time.monotonic() - self._loaded_at < self.refresh_interval
+            if fresh or (same_day and self._refreshing):
+                return self._today, self._month
+            self._refreshing = True
+        try:
+            self._refresh()
+        except Exception as e:
+            print(f"⚠️ 讀取 API 用量失敗，沿用上次的數字: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+        with self._lock:
+            return self._today, self._month
+
+    def record(self, lane, calls=1):
+        today = datetime.now(timezone.utc).date()
+        with self.pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                INSERT INTO api_usage (provider, day, lane, calls) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (provider, day, lane) DO UPDATE SET calls = api_usage.calls + EXCLUDED.calls
+            """, (self.provider, today, lane, calls))
+            conn.commit()
+            c.close()
+        with self._lock:
+            if self._day == today:
+                self._today += calls
+                self._month += calls
+
+
+class ApiBudget:
+    """
+    - daily_quota / monthly_quota: 每日 / 每月可用次數 (0 = 不限制)
+    - background_reserve: 保留給 interactive 的比例，用量超過 (1 - reserve) 後 background 請求延後
+    """
+
+    def __init__(self, bucket, ledger, daily_quota=0, monthly_quota=0, background_reserve=0.2):
+        self.bucket = bucket
+        self.ledger = ledger
+        self.daily_quota = daily_quota
+        self.monthly_quota = monthly_quota
+        self.background_reserve = background_reserve
+        self._lock = threading.Lock()
+        self._rejected = {INTERACTIVE: 0, BACKGROUND: 0}
+
+    def _limits(self, lane):
+        share = 1.0 if lane == INTERACTIVE else 1.0 - self.background_reserve
+        return self.daily_quota * share, self.monthly_quota * share
+
+    def check(self, lane):
+        """額度不足時丟出 QuotaExceeded"""
+        if not self.daily_quota and not self.monthly_quota:
+            return
+        used_today, used_month = self.ledger.usage()
+        daily_limit, monthly_limit = self._limits(lane)
+        reason = None
+        if self.daily_quota and used_today >= daily_limit:
+            reason = f"今日額度 {used_today}/{self.daily_quota}"
+        elif self.monthly_quota and used_month >= monthly_limit:
+            reason = f"本月額度 {used_month}/{self.monthly_quota}"
+        if reason:
+            with self._lock:
+                self._rejected[lane] += 1
+            raise QuotaExceeded(lane, f"RapidAPI {reason} ({lane})")
+
+    def background_allowed(self):
+        try:
+            self.check(BACKGROUND)
+            return True
+        except QuotaExceeded:
+            return False
+
+    def acquire(self, lane=BACKGROUND):
+        """送出一次請求前呼叫：檢查額度 -> 限速 -> 記帳"""
+        self.check(lane)
+        self.bucket.acquire(lane)
+        try:
+            self.ledger.record(lane)
+        except Exception as e:
+            print(f"⚠️ API 用量記帳失敗: {e}")
+
+    def stats(self):
+        used_today, used_month = self.ledger.usage()
+        with self._lock:
+            rejected = dict(self._rejected)
+        return {
+            "daily_quota": self.daily_quota,
+            "monthly_quota": self.monthly_quota,
+            "background_reserve": self.background_reserve,
+            "used_today": used_today,
+            "used_month": used_month,
+            "background_allowed": self.background_allowed(),
+            "rejected": rejected,
+            "bucket": self.bucket.stats(),
+        }
+
+
+class CircuitBreaker:
+    """
+    closed: 正常呼叫，記錄最近 window_size 次結果；至少 min_calls 次且失敗率 >= failure_threshold 時開啟
+    open: 直接丟出 CircuitOpen，open_seconds 後進入 half_open
+    half_open: 只放行 half_open_probes 個試探請求，成功就關閉，失敗則再開啟 (開啟時間加倍，上限 max_open_seconds)
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, window_size=20, min_calls=5, failure_threshold=0.5,
+                 open_seconds=30, max_open_seconds=600, half_open_probes=1):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.half_open_probes = half_open_probes
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._results = deque(maxlen=window_size)  # True = 成功
+        self._open_until = 0.0
+        self._current_open = open_seconds
+        self._probes = 0
+        self._stats = {"opened": 0, "rejected": 0, "successes": 0, "failures": 0}
+
+    def _transition(self, state):
+        print(f"🔌 Circuit {self.name}: {self._state} -> {state}")
+        self._state = state
+
+    def _open(self, seconds):
+        self._current_open = seconds
+        self._open_until = time.monotonic() + seconds
+        self._probes = 0
+        self._stats["opened"] += 1
+        self._transition(self.OPEN)
+
+    def allow(self):
+        """呼叫前檢查，不能呼叫時丟出 CircuitOpen"""
+        with self._lock:
+            if self._state == self.OPEN:
+                remaining = self._open_until - time.monotonic()
+                if remaining > 0:
+                    self._stats["rejected"] += 1
+                    raise CircuitOpen(f"{self.name} circuit 開啟中，{remaining:.0f} 秒後再試", remaining)
+                self._probes = 0
+                self._transition(self.HALF_OPEN)
+
+            if self._state == self.HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    self._stats["rejected"] += 1
+                    raise CircuitOpen(f"{self.name} circuit 試探中", 1.0)
+                self._probes += 1
+
+    def is_open(self):
+        with self._lock:
+            return self._state == self.OPEN and time.monotonic() < self._open_until
+
+    def on_success(self):
+        with self._lock:
+            self._stats["successes"] += 1
+            if self._state == self.HALF_OPEN:
+                self._results.clear()
+                self._current_open = self.open_seconds
+                self._transition(self.CLOSED)
+            elif self._state == self.CLOSED:
+                self._results.append(True)
+
+    def on_failure(self):
+        with self._lock:
+            self._stats["failures"] += 1
+            if self._state == self.HALF_OPEN:
+                self._open(min(self._current_open * 2, self.max_open_seconds))
+            elif self._state == self.CLOSED:
+                self._results.append(False)
+                failures = self._results.count(False)
+                if len(self._results) >= self.min_calls and failures / len(self._results) >= self.failure_threshold:
+                    self._results.clear()
+                    self._open(self.open_seconds)
+
+    def on_ignored(self):
+        """呼叫沒有真正送出 (例如額度不足)：歸還 half_open 的試探名額"""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            total = len(self._results)
+            data.update({
+                "name": self.name,
+                "state": self._state,
+                "window": total,
+                "failure_rate": round(self._results.count(False) / total, 3) if total else 0.0,
+                "retry_after": round(max(0.0, self._open_until - time.monotonic()), 1)
+                if self._state == self.OPEN else 0.0,
+            })
+        return data
+
+
+def is_retryable(error):
+    if isinstance(error, UpstreamError):
+        return error.status_code in RETRYABLE_STATUS
+    return isinstance(error, (requests.Timeout, requests.ConnectionError))
+
+
+def backoff_delay(attempt, base, cap):
+    """full jitter：0 ~ min(cap, base * 2^attempt) 之間隨機"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def call_with_retry(fn, breaker, retries=2, base=0.5, cap=8.0):
+    """
+    fn() 送出一次請求；可重試的錯誤 (429 / 5xx / 逾時 / 連線錯誤) 計入 breaker 並退避重試
+    其他錯誤 (例如 4xx、額度不足) 直接丟出，不算上游故障
+    """
+    attempt = 0
+    while True:
+        breaker.allow()
+        try:
+            result = fn()
+        except Exception as e:
+            if not is_retryable(e):
+                if isinstance(e, UpstreamError):
+                    breaker.on_success()  # 上游有正常回應，只是請求本身有問題
+                else:
+                    breaker.on_ignored()
+                raise
+            breaker.on_failure()
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt, base, cap)
+            if getattr(e, "retry_after", None):
+                delay = max(delay, min(e.retry_after, cap))
+            attempt += 1
+            print(f"🔁 上游錯誤 ({e})，{delay:.1f} 秒後第 {attempt} 次重試")
+            time.sleep(delay)
+            continue
+        breaker.on_success()
+        return result